@@ -2,31 +2,47 @@
 # VERSÃO ATUALIZADA (Transpositor + Banco de Dados da Escala no Turso)
 
 from fastapi import FastAPI, File, UploadFile, Form
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
 import re
 import docx
 import io
-from typing import List, Optional
+from typing import List, Optional, NamedTuple
 import os
 import libsql_client
+import aiohttp
 import random
 import difflib
+import heapq
 import gspread
 import json
 from datetime import datetime, timedelta
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, status, Header
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import BackgroundTasks # NOVO: Para enviar o email sem travar a tela
 import smtplib
 import ssl
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import string
+import asyncio
+import time
+from collections import OrderedDict, defaultdict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import threading
+import sqlite3
+import shutil
+import codecs
+import csv
+import hashlib
+from urllib.parse import quote
+from fastapi.responses import StreamingResponse
+from functools import lru_cache
+import unicodedata
 
 # Isso faz o Python ler o arquivo .env invisível no seu computador
 load_dotenv()
@@ -35,9 +51,220 @@ load_dotenv()
 TURSO_URL = os.getenv("TURSO_DATABASE_URL")
 TURSO_TOKEN = os.getenv("TURSO_AUTH_TOKEN")
 
+# Tamanho do pool, tempo máximo de espera por um cliente livre e intervalo do health check
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", "30"))
+
+# Backend: "libsql" (Turso, padrão) ou "sqlite" (arquivo local ou ":memory:", sem rede).
+# No sqlite, um banco que ainda não existe nasce como cópia de DB_SQLITE_SEED (vazio = banco em branco).
+DB_BACKEND = os.getenv("DB_BACKEND", "libsql").lower()
+DB_SQLITE_PATH = os.getenv("DB_SQLITE_PATH", "levi.db")
+DB_SQLITE_SEED = os.getenv("DB_SQLITE_SEED", os.path.join(os.path.dirname(os.path.abspath(__file__)), "musicas.db"))
+
+class ClienteSQLite:
+    """Mesma interface do libsql_client.Client (execute, batch, close, closed) sobre o sqlite3 local.
+
+    Cada cliente mantém uma conexão aberta e roda os comandos numa thread própria, para não
+    bloquear o event loop. Em ":memory:" todos os clientes compartilham a mesma conexão
+    (senão cada um enxergaria um banco vazio diferente).
+    """
+
+    _memoria = None
+    _trava_memoria = threading.Lock()
+
+    def __init__(self, caminho: str, semente: Optional[str] = None):
+        if caminho == ":memory:":
+            with ClienteSQLite._trava_memoria:
+                if ClienteSQLite._memoria is None:
+                    conn = self._conectar(caminho)
+                    if semente and os.path.exists(semente):
+                        with sqlite3.connect(semente) as origem: origem.backup(conn)
+                    ClienteSQLite._memoria = conn
+            self._conn, self._trava = ClienteSQLite._memoria, ClienteSQLite._trava_memoria
+        else:
+            if semente and os.path.exists(semente) and not os.path.exists(caminho):
+                shutil.copyfile(semente, caminho)
+            self._conn, self._trava = self._conectar(caminho), threading.Lock()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._compartilhada = caminho == ":memory:"
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._closed = False
+
+    @staticmethod
+    def _conectar(caminho):
+        # isolation_level=None: o batch controla BEGIN/COMMIT, como o libsql faz
+        return sqlite3.connect(caminho, isolation_level=None, check_same_thread=False, timeout=5)
+
+    def _executar(self, stmt, args=None):
+        stmt = libsql_client.Statement.convert(stmt, args)
+        if isinstance(stmt.args, dict):
+            params = {k.lstrip(":$@"): v for k, v in stmt.args.items()}
+        else:
+            params = list(stmt.args or [])
+        try:
+            cursor = self._conn.execute(stmt.sql, params)
+            linhas = cursor.fetchall()
+        except sqlite3.Error as e:
+            raise libsql_client.LibsqlError(str(e), getattr(e, "sqlite_errorname", "SQLITE")) from e
+        colunas = tuple(d[0] for d in cursor.description or ())
+        indices = {coluna: i for i, coluna in enumerate(colunas)}
+        return libsql_client.ResultSet(colunas, [libsql_client.Row(indices, linha) for linha in linhas],
+                                       max(cursor.rowcount, 0), cursor.lastrowid)
+
+    def _execute_sync(self, stmt, args):
+        with self._trava:
+            return self._executar(stmt, args)
+
+    def _batch_sync(self, stmts):
+        with self._trava:
+            self._executar("BEGIN")
+            try:
+                resultados = [self._executar(stmt) for stmt in stmts]
+                self._executar("COMMIT")
+                return resultados
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def _na_thread(self, fn, *args):
+        if self._closed: raise libsql_client.LibsqlError("The client was closed", "CLIENT_CLOSED")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def execute(self, stmt, args=None):
+        return await self._na_thread(self._execute_sync, stmt, args)
+
+    async def batch(self, stmts):
+        return await self._na_thread(self._batch_sync, stmts)
+
+    async def close(self):
+        if self._closed: return
+        self._closed = True
+        self._executor.shutdown(wait=True)
+        if not self._compartilhada: self._conn.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
 def get_db_client():
+    if DB_BACKEND == "sqlite":
+        return ClienteSQLite(DB_SQLITE_PATH, DB_SQLITE_SEED)
     return libsql_client.create_client(url=TURSO_URL, auth_token=TURSO_TOKEN)
 
+# Códigos do libsql_client que indicam conexão perdida (e não erro do SQL, como constraint ou sintaxe)
+CODIGOS_FALHA_CONEXAO = {"CLIENT_CLOSED", "STREAM_CLOSED", "HRANA_WEBSOCKET_ERROR", "HRANA_PROTO_ERROR", "SERVER_ERROR"}
+
+def falha_de_conexao(e: BaseException) -> bool:
+    if isinstance(e, libsql_client.LibsqlError): return e.code in CODIGOS_FALHA_CONEXAO
+    return isinstance(e, (OSError, asyncio.TimeoutError, aiohttp.ClientError))
+
+class ClienteDoPool:
+    """Cliente emprestado pelo pool: repassa execute/batch e anota se algum falhou por conexão.
+
+    As rotas capturam as exceções do banco (e devolvem {"error": ...}), então o pool não as
+    vê passar; a marca `suspeito` é o que faz ele conferir o cliente antes do próximo empréstimo.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.suspeito = False
+
+    async def _chamar(self, metodo, *args):
+        try:
+            return await metodo(*args)
+        except asyncio.CancelledError:
+            self.suspeito = True  # resposta abandonada no meio do caminho
+            raise
+        except Exception as e:
+            if falha_de_conexao(e): self.suspeito = True
+            raise
+
+    async def execute(self, stmt, args=None):
+        return await self._chamar(self.client.execute, stmt, args)
+
+    async def batch(self, stmts):
+        return await self._chamar(self.client.batch, stmts)
+
+    async def close(self):
+        await self.client.close()
+
+    @property
+    def closed(self):
+        return self.client.closed
+
+class PoolConexoes:
+    """Clientes Turso abertos uma única vez (no lifespan) e reaproveitados por todas as rotas.
+
+    Um cliente marcado como suspeito volta para a fila com o health check vencido: o próximo
+    empréstimo roda o SELECT 1 e, se falhar, troca o cliente por um novo.
+    """
+
+    def __init__(self, tamanho: int, timeout: float, intervalo_healthcheck: float):
+        self.tamanho = tamanho
+        self.timeout = timeout
+        self.intervalo_healthcheck = intervalo_healthcheck
+        self._livres: Optional[asyncio.Queue] = None
+        self._fechado = False
+
+    async def abrir(self):
+        self._fechado = False
+        self._livres = asyncio.Queue()
+        for _ in range(self.tamanho):
+            # Cada item da fila guarda o cliente e o instante do último health check que passou
+            self._livres.put_nowait((ClienteDoPool(get_db_client()), time.monotonic()))
+
+    async def _reconectar(self, client):
+        try: await client.close()
+        except Exception: pass
+        return ClienteDoPool(get_db_client())
+
+    async def _garantir_saudavel(self, client, verificado_em):
+        if client.closed:
+            return await self._reconectar(client), time.monotonic()
+        if time.monotonic() - verificado_em < self.intervalo_healthcheck:
+            return client, verificado_em
+        try:
+            await client.execute("SELECT 1")
+        except Exception as e:
+            print(f"AVISO: Health check do banco falhou ({e}). Reconectando...")
+            client = await self._reconectar(client)
+        return client, time.monotonic()
+
+    @asynccontextmanager
+    async def conexao(self):
+        if self._livres is None or self._fechado:
+            raise HTTPException(status_code=503, detail="Banco de dados indisponível.")
+        try:
+            client, verificado_em = await asyncio.wait_for(self._livres.get(), self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Banco de dados ocupado. Tente novamente.")
+
+        client, verificado_em = await self._garantir_saudavel(client, verificado_em)
+        try:
+            yield client
+        finally:
+            if client.suspeito:
+                # Falha de conexão no meio da rota: o health check roda antes do próximo uso
+                client.suspeito = False
+                verificado_em = float("-inf")
+            if self._fechado: await client.close()
+            else: self._livres.put_nowait((client, verificado_em))
+
+    async def fechar(self):
+        self._fechado = True
+        if self._livres is None: return
+        while not self._livres.empty():
+            client, _ = self._livres.get_nowait()
+            await client.close()
+
+db_pool = PoolConexoes(DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_HEALTHCHECK_INTERVAL)
+
+async def get_db():
+    """Dependência do FastAPI: empresta um cliente do pool durante a requisição."""
+    async with db_pool.conexao() as client:
+        yield client
+
 # --- Configuração de Segurança (JWT e Senhas) ---
 SECRET_KEY = os.getenv("SECRET_KEY", "uma_chave_secreta_super_segura_aqui_para_desenvolvimento")
 ALGORITHM = "HS256"
@@ -52,13 +279,113 @@ def get_password_hash(password):
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+# --- Pool dedicado ao bcrypt (o hash leva centenas de ms e travaria o event loop) ---
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+HASH_MAX_FILA = int(os.getenv("HASH_MAX_FILA", "32"))
+
+class PoolHash:
+    """Executa hash/verificação de senha em threads, com limite de concorrência e de fila."""
+
+    def __init__(self, workers: int, max_fila: int):
+        self.workers = workers
+        self.max_fila = max_fila
+        self.pendentes = 0
+        self.rejeitadas = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def abrir(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+
+    async def executar(self, fn, *args):
+        # Acima do limite de fila é melhor recusar logo do que acumular logins esperando
+        if self.pendentes >= self.max_fila:
+            self.rejeitadas += 1
+            raise HTTPException(status_code=503, detail="Servidor ocupado. Tente novamente em instantes.")
+        self.pendentes += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pendentes -= 1
+
+    def fechar(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self):
+        return {"workers": self.workers, "pendentes": self.pendentes, "max_fila": self.max_fila, "rejeitadas": self.rejeitadas}
+
+pool_hash = PoolHash(HASH_WORKERS, HASH_MAX_FILA)
+
+async def get_password_hash_async(password):
+    return await pool_hash.executar(get_password_hash, password)
+
+async def verify_password_async(plain_password, hashed_password):
+    return await pool_hash.executar(verify_password, plain_password, hashed_password)
+
+# --- Cache de usuários autenticados (evita um SELECT em usuarios a cada requisição) ---
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "1000"))
+
+class CacheUsuarios:
+    """Cache LRU com TTL, indexado pelo id do usuário (o 'sub' do JWT)."""
+
+    def __init__(self, ttl: float, max_itens: int):
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self._itens = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        item = self._itens.get(str(user_id))
+        if item is None or item[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._itens.move_to_end(str(user_id))
+        self.hits += 1
+        return dict(item[1])
+
+    def set(self, user_id, user: dict):
+        self._itens[str(user_id)] = (time.monotonic() + self.ttl, user)
+        self._itens.move_to_end(str(user_id))
+        while len(self._itens) > self.max_itens:
+            self._itens.popitem(last=False)
+
+    def invalidar(self, user_id):
+        self._itens.pop(str(user_id), None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "itens": len(self._itens), "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+cache_usuarios = CacheUsuarios(USER_CACHE_TTL, USER_CACHE_MAX)
+
+async def buscar_usuario(client, user_id):
+    """Retorna o usuário do cache ou, se expirado/ausente, do banco (e guarda no cache)."""
+    user = cache_usuarios.get(user_id)
+    if user is not None: return user
+    return await carregar_usuario(client, user_id)
+
+async def carregar_usuario(client, user_id):
+    """Lê o usuário no banco e guarda no cache."""
+    result = await client.execute("SELECT id, email, usar_banco_padrao FROM usuarios WHERE id = ?", [user_id])
+    if not result.rows: return None
+    row = result.rows[0]
+    user = {"id": row[0], "email": row[1], "usar_banco_padrao": row[2]}
+    cache_usuarios.set(user_id, user)
+    return dict(user)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta if expires_delta else timedelta(minutes=15))
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(token: str = Depends(oauth2_scheme), client: libsql_client.Client = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Não foi possível validar as credenciais",
@@ -72,15 +399,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
     
-    client = get_db_client()
-    try:
-        result = await client.execute("SELECT id, email, usar_banco_padrao FROM usuarios WHERE id = ?", [user_id])
-        if not result.rows:
-            raise credentials_exception
-        user = result.rows[0]
-        return {"id": user[0], "email": user[1], "usar_banco_padrao": user[2]}
-    finally:
-        await client.close()
+    user = await buscar_usuario(client, user_id)
+    if user is None:
+        raise credentials_exception
+    return user
 
 # --- Modelos de Dados ---
 class UserCreate(BaseModel):
@@ -95,6 +417,9 @@ class FuncaoRequest(BaseModel):
     nome: str
     membros_ids: Optional[List[int]] = []
 
+class MembrosFuncaoRequest(BaseModel):
+    membros_ids: List[int]
+
 class MembroRequest(BaseModel):
     nome: str
     telefone: Optional[str] = ""
@@ -120,52 +445,225 @@ class TransposeSequenceResponse(BaseModel):
     transposed_chords: List[str]
     explanations: List[str]
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    client = get_db_client()
-    await client.execute('''
-        CREATE TABLE IF NOT EXISTS usuarios (
+class TransposeAllKeysRequest(BaseModel):
+    cifra_text: str
+    # Sem lista = os 12 tons (0 a 11 semitons acima). Mais de 12 é repetição (422 antes de renderizar qualquer coisa)
+    semitons: Optional[List[int]] = Field(None, max_length=12)
+
+class TransposeAllKeysItem(BaseModel):
+    semitons: int
+    transposed_cifra: str
+
+class TransposeAllKeysResponse(BaseModel):
+    transposicoes: List[TransposeAllKeysItem]
+
+class TransposeBatchRequest(BaseModel):
+    itens: List[TransposeCifraRequest]
+
+class TransposeBatchItem(BaseModel):
+    transposed_cifra: Optional[str] = None
+    error: Optional[str] = None
+
+class TransposeBatchResponse(BaseModel):
+    resultados: List[TransposeBatchItem]
+
+# ==========================================================
+# MIGRAÇÕES DE ESQUEMA (VERSIONADAS)
+# ==========================================================
+# Cada passo roda uma única vez por banco; a versão aplicada fica em schema_migracoes.
+# Passos novos entram SEMPRE no fim da lista, com a próxima versão.
+
+class Coluna(NamedTuple):
+    """ALTER TABLE ... ADD COLUMN que só é emitido se a coluna ainda não existir
+    (bancos anteriores às migrações já receberam parte delas pelo antigo ALTER-e-ignora)."""
+    tabela: str
+    nome: str
+    definicao: str
+
+CATEGORIAS_PADRAO = ["agitadas1", "agitadas2", "lentas1", "lentas2", "ceia", "infantis"]
+
+MIGRACOES = [
+    (1, "Estrutura base", [
+        '''CREATE TABLE IF NOT EXISTS usuarios (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT UNIQUE NOT NULL,
             senha TEXT NOT NULL,
             usar_banco_padrao BOOLEAN DEFAULT 1
-        )
-    ''')
-    # --- NOVA TABELA DE CATEGORIAS FASE 4 ---
-    await client.execute('''
-        CREATE TABLE IF NOT EXISTS categorias_repertorio (
+        )''',
+        # --- NOVA TABELA DE CATEGORIAS FASE 4 ---
+        '''CREATE TABLE IF NOT EXISTS categorias_repertorio (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             nome TEXT NOT NULL,
             usuario_id INTEGER
-        )
-    ''')
-    
-    # --- NOVA COLUNA FASE 5 (PADRÃO DE ESCALA) ---
-    try: await client.execute("ALTER TABLE usuarios ADD COLUMN funcoes_padrao TEXT DEFAULT 'Mídia,Voz e violão,Voz 1,Voz 2,Voz 3'")
-    except: pass
-    
-    # --- NOVAS COLUNAS DE SEGURANÇA ---
-    # DEFAULT 1 salva a sua conta antiga. Novas contas serão forçadas a 0 no ato do cadastro.
-    try: await client.execute("ALTER TABLE usuarios ADD COLUMN is_verified BOOLEAN DEFAULT 1")
-    except: pass
-    try: await client.execute("ALTER TABLE usuarios ADD COLUMN verification_code TEXT")
-    except: pass
-    
-    tabelas = ["membros", "funcoes", "biblioteca_busca", "agitadas1", "agitadas2", "lentas1", "lentas2", "ceia", "infantis"]
-    for tabela in tabelas:
-        try: await client.execute(f"ALTER TABLE {tabela} ADD COLUMN usuario_id INTEGER")
-        except Exception: pass 
-        
-    try: await client.execute("ALTER TABLE biblioteca_busca ADD COLUMN link TEXT DEFAULT ''")
-    except: pass
-    try: await client.execute("ALTER TABLE biblioteca_busca ADD COLUMN categoria TEXT DEFAULT 'agitadas1'")
-    except: pass
-    for t in ["agitadas1", "agitadas2", "lentas1", "lentas2", "ceia", "infantis"]:
-        try: await client.execute(f"ALTER TABLE {t} ADD COLUMN link TEXT DEFAULT ''")
-        except: pass
-
-    await client.close()
-    yield
+        )''',
+        # Antes criada pelo migrar_db.py
+        '''CREATE TABLE IF NOT EXISTS biblioteca_busca (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome_musica TEXT NOT NULL,
+            tags TEXT NOT NULL
+        )''',
+        "CREATE TABLE IF NOT EXISTS membros (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS funcoes (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT UNIQUE NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS membro_funcoes (membro_id INTEGER, funcao_id INTEGER, PRIMARY KEY (membro_id, funcao_id))",
+        # Antes criadas pelo migrar_sorteio.py
+        *[f"CREATE TABLE IF NOT EXISTS {t} (id INTEGER PRIMARY KEY AUTOINCREMENT, conteudo TEXT)" for t in CATEGORIAS_PADRAO],
+    ]),
+    # Antigo update_db.py
+    (2, "Gestão completa da equipe", [
+        Coluna("membros", "telefone", "TEXT DEFAULT ''"),
+        Coluna("membros", "email", "TEXT DEFAULT ''"),
+        Coluna("membros", "status", "TEXT DEFAULT 'ativo'"),
+    ]),
+    # --- NOVA COLUNA FASE 5 (PADRÃO DE ESCALA) E NOVAS COLUNAS DE SEGURANÇA ---
+    # is_verified DEFAULT 1 salva as contas antigas. Novas contas são forçadas a 0 no ato do cadastro.
+    (3, "Padrão de escala e verificação de email", [
+        Coluna("usuarios", "funcoes_padrao", "TEXT DEFAULT 'Mídia,Voz e violão,Voz 1,Voz 2,Voz 3'"),
+        Coluna("usuarios", "is_verified", "BOOLEAN DEFAULT 1"),
+        Coluna("usuarios", "verification_code", "TEXT"),
+    ]),
+    (4, "Multi-tenant, links e categorias", [
+        *[Coluna(t, "usuario_id", "INTEGER") for t in ["membros", "funcoes", "biblioteca_busca", *CATEGORIAS_PADRAO]],
+        Coluna("biblioteca_busca", "link", "TEXT DEFAULT ''"),
+        Coluna("biblioteca_busca", "categoria", "TEXT DEFAULT 'agitadas1'"),
+        *[Coluna(t, "link", "TEXT DEFAULT ''") for t in CATEGORIAS_PADRAO],
+    ]),
+    # --- CIFRAS SALVAS NO SERVIDOR (JÁ TOKENIZADAS) ---
+    (5, "Cifras salvas", [
+        '''CREATE TABLE IF NOT EXISTS cifras (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            titulo TEXT NOT NULL,
+            texto TEXT NOT NULL,
+            tokens TEXT NOT NULL,
+            musica_id INTEGER,
+            usuario_id INTEGER NOT NULL
+        )''',
+    ]),
+    # Quase toda consulta filtra por usuario_id (os "IS NULL" do banco padrão também usam o índice).
+    # O verificar_planos.py confere que nenhuma consulta do api.py volta a varrer a tabela inteira.
+    (6, "Índices das consultas por tenant", [
+        "CREATE INDEX IF NOT EXISTS idx_membros_usuario ON membros (usuario_id, nome)",
+        "CREATE INDEX IF NOT EXISTS idx_funcoes_usuario ON funcoes (usuario_id)",
+        "CREATE INDEX IF NOT EXISTS idx_membro_funcoes_membro ON membro_funcoes (membro_id, funcao_id)",
+        "CREATE INDEX IF NOT EXISTS idx_membro_funcoes_funcao ON membro_funcoes (funcao_id, membro_id)",
+        "CREATE INDEX IF NOT EXISTS idx_biblioteca_busca_usuario ON biblioteca_busca (usuario_id, categoria)",
+        "CREATE INDEX IF NOT EXISTS idx_categorias_repertorio_usuario ON categorias_repertorio (usuario_id)",
+        "CREATE INDEX IF NOT EXISTS idx_cifras_usuario ON cifras (usuario_id, musica_id)",
+        *[f"CREATE INDEX IF NOT EXISTS idx_{t}_usuario ON {t} (usuario_id)" for t in CATEGORIAS_PADRAO],
+    ]),
+    # Fila de e-mails: a linha some quando o envio dá certo; proxima_tentativa NULL = desistiu (o erro fica guardado)
+    (7, "Fila de e-mails", [
+        '''CREATE TABLE IF NOT EXISTS emails_pendentes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            destinatario TEXT NOT NULL,
+            assunto TEXT NOT NULL,
+            corpo TEXT NOT NULL,
+            tentativas INTEGER NOT NULL DEFAULT 0,
+            proxima_tentativa REAL,
+            ultimo_erro TEXT,
+            criado_em TEXT NOT NULL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_emails_pendentes_proxima ON emails_pendentes (proxima_tentativa)",
+    ]),
+    # Espelho FTS5 (nome_musica, tags) da biblioteca_busca, mantido por triggers. É uma tabela de conteúdo
+    # externo: o texto fica só na biblioteca_busca e o FTS guarda o índice. O usuario_id vai junto
+    # (UNINDEXED) para filtrar o tenant sem precisar do JOIN. Só é aplicada com BUSCA_MODO=fts (MIGRACOES_FTS):
+    # quem liga o modo fts depois recebe este passo na subida seguinte, mesmo que já existam passos mais novos.
+    (8, "Índice FTS5 da busca", [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS biblioteca_busca_fts USING fts5(
+            nome_musica, tags, usuario_id UNINDEXED,
+            content='biblioteca_busca', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )""",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS biblioteca_busca_fts_vocab USING fts5vocab(biblioteca_busca_fts, 'row')",
+        """CREATE TRIGGER IF NOT EXISTS biblioteca_busca_fts_ai AFTER INSERT ON biblioteca_busca BEGIN
+            INSERT INTO biblioteca_busca_fts(rowid, nome_musica, tags, usuario_id) VALUES (new.id, new.nome_musica, new.tags, new.usuario_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS biblioteca_busca_fts_ad AFTER DELETE ON biblioteca_busca BEGIN
+            INSERT INTO biblioteca_busca_fts(biblioteca_busca_fts, rowid, nome_musica, tags, usuario_id) VALUES ('delete', old.id, old.nome_musica, old.tags, old.usuario_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS biblioteca_busca_fts_au AFTER UPDATE ON biblioteca_busca BEGIN
+            INSERT INTO biblioteca_busca_fts(biblioteca_busca_fts, rowid, nome_musica, tags, usuario_id) VALUES ('delete', old.id, old.nome_musica, old.tags, old.usuario_id);
+            INSERT INTO biblioteca_busca_fts(rowid, nome_musica, tags, usuario_id) VALUES (new.id, new.nome_musica, new.tags, new.usuario_id);
+        END""",
+        # Indexa o que já estava na tabela (depois disso os triggers cuidam de tudo)
+        "INSERT INTO biblioteca_busca_fts(biblioteca_busca_fts) VALUES ('rebuild')",
+    ]),
+]
+VERSAO_ESQUEMA = MIGRACOES[-1][0]
+MIGRACOES_FTS = {8}
+
+async def versoes_aplicadas(client):
+    try:
+        result = await client.execute("SELECT versao FROM schema_migracoes")
+        return {row[0] for row in result.rows}
+    except Exception:
+        return set() # Banco anterior às migrações (ou novo em folha)
+
+def migracoes_pendentes(aplicadas, fts=None):
+    """Passos ainda não aplicados; os de MIGRACOES_FTS só entram com a busca em modo fts."""
+    if fts is None: fts = BUSCA_MODO == "fts"
+    return [m for m in MIGRACOES if m[0] not in aplicadas and (fts or m[0] not in MIGRACOES_FTS)]
+
+async def aplicar_migracoes(client, verbose=False, fts=None):
+    """Aplica num único batch (uma transação) só as migrações pendentes.
+
+    Com o banco em dia, custa um SELECT. Retorna a lista de versões aplicadas.
+    `fts` força a inclusão (ou não) dos passos do FTS; o padrão segue o BUSCA_MODO.
+    """
+    pendentes = migracoes_pendentes(await versoes_aplicadas(client), fts)
+    if not pendentes: return []
+
+    # Uma consulta para saber as colunas que já existem em todas as tabelas
+    result = await client.execute(
+        "SELECT m.name, p.name FROM sqlite_master m JOIN pragma_table_info(m.name) p WHERE m.type = 'table'")
+    existentes = {(tabela, coluna) for tabela, coluna in result.rows}
+
+    statements = ["CREATE TABLE IF NOT EXISTS schema_migracoes (versao INTEGER PRIMARY KEY, descricao TEXT NOT NULL, aplicada_em TEXT NOT NULL)"]
+    for numero, descricao, passos in pendentes:
+        for passo in passos:
+            if isinstance(passo, Coluna):
+                if (passo.tabela, passo.nome) in existentes: continue
+                existentes.add((passo.tabela, passo.nome))
+                statements.append(f"ALTER TABLE {passo.tabela} ADD COLUMN {passo.nome} {passo.definicao}")
+            else:
+                statements.append(passo)
+        statements.append(libsql_client.Statement(
+            "INSERT INTO schema_migracoes (versao, descricao, aplicada_em) VALUES (?, ?, ?)",
+            [numero, descricao, datetime.utcnow().isoformat(timespec="seconds")]))
+        if verbose: print(f"➡️  {numero:>3} {descricao}")
+
+    try:
+        await client.batch(statements)
+    except Exception:
+        # Outro worker pode ter migrado ao mesmo tempo (o batch dele venceu e o nosso foi desfeito)
+        if not migracoes_pendentes(await versoes_aplicadas(client), fts): return []
+        raise
+    return [m[0] for m in pendentes]
+
+async def criar_estrutura_banco(client):
+    await aplicar_migracoes(client)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db_pool.abrir()
+    pool_hash.abrir()
+    pool_transposicao.abrir()
+    try:
+        async with db_pool.conexao() as client:
+            await criar_estrutura_banco(client)
+        await repertorio_padrao.iniciar()
+        fila_sugestoes.iniciar()
+        fila_emails.iniciar()
+        yield
+    finally:
+        await fila_emails.parar()
+        await indices_busca.parar()
+        await fila_sugestoes.parar()
+        await repertorio_padrao.parar()
+        pool_transposicao.fechar()
+        pool_hash.fechar()
+        await db_pool.fechar()
+
 app = FastAPI(lifespan=lifespan)
 
 # --- Configuração CORS (LIBERADO PARA ANDROID E FRONTEND) ---
@@ -181,19 +679,28 @@ app.add_middleware(
 # ROTAS DE AUTENTICAÇÃO, EMAILS E USUÁRIOS
 # ==========================================================
 
-def enviar_email_verificacao(destinatario: str, codigo: str):
-    remetente = os.getenv("SMTP_EMAIL")
-    senha = os.getenv("SMTP_PASSWORD")
-    if not remetente or not senha:
-        print(f"AVISO: Email não configurado no .env. O código para {destinatario} é: {codigo}")
-        return
-
-    msg = MIMEMultipart()
-    msg['From'] = remetente
-    msg['To'] = destinatario
-    msg['Subject'] = "Verifique a sua conta no LeviHub 🎸"
-
-    body = f"""Olá Abençoado(a)!
+# --- Fila de e-mails (códigos de verificação) ---
+# O cadastro grava o e-mail em emails_pendentes na mesma transação do usuário. Um laço por processo
+# reserva os pendentes, manda em lotes pela mesma conexão SMTP (aberta uma vez e mantida enquanto
+# houver movimento) e respeita EMAIL_POR_MINUTO. Falhas voltam para a tabela com backoff.
+# Para testar sem Gmail: python -m aiosmtpd -n -l localhost:8025  +  SMTP_HOST=localhost SMTP_PORT=8025 SMTP_SSL=0
+SMTP_EMAIL = os.getenv("SMTP_EMAIL")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_SSL = os.getenv("SMTP_SSL", "1") == "1"
+EMAIL_LOTE = int(os.getenv("EMAIL_LOTE", "20"))
+EMAIL_POR_MINUTO = float(os.getenv("EMAIL_POR_MINUTO", "30"))
+EMAIL_MAX_TENTATIVAS = int(os.getenv("EMAIL_MAX_TENTATIVAS", "6"))
+EMAIL_INTERVALO = float(os.getenv("EMAIL_INTERVALO", "30"))  # varredura da tabela mesmo sem cadastro novo
+EMAIL_OCIOSO = float(os.getenv("EMAIL_OCIOSO", "60"))  # fecha a conexão SMTP parada há mais que isso
+SMTP_TIMEOUT = 30  # segundos por operação no socket SMTP
+# Folga da reserva além do tempo do lote no ritmo EMAIL_POR_MINUTO: cobre conectar e mandar uma mensagem
+EMAIL_RESERVA_FOLGA = 4 * SMTP_TIMEOUT
+
+def montar_email_verificacao(codigo: str):
+    assunto = "Verifique a sua conta no LeviHub 🎸"
+    corpo = f"""Olá Abençoado(a)!
     
 Bem-vindo ao LeviHub! O seu código de verificação é:
 
@@ -202,87 +709,292 @@ Bem-vindo ao LeviHub! O seu código de verificação é:
 Insira este código na tela de cadastro para ativar a sua conta.
 
 Deus abençoe!"""
-    
-    msg.attach(MIMEText(body, 'plain'))
+    return assunto, corpo
+
+def erro_permanente(e: Exception) -> bool:
+    """Endereço recusado ou mensagem rejeitada (5xx): tentar de novo não adianta."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(codigo >= 500 for codigo, _ in e.recipients.values())
+    return (isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+            and not isinstance(e, smtplib.SMTPAuthenticationError))
+
+def resumir_erro(e: Exception) -> str:
+    """Erro para as métricas, sem endereço: recusas e respostas do servidor costumam citar o destinatário."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        codigos = sorted({codigo for codigo, _ in e.recipients.values()})
+        return f"destinatário recusado ({', '.join(map(str, codigos))})"
+    if isinstance(e, smtplib.SMTPResponseException):
+        return f"{type(e).__name__} ({e.smtp_code})"
+    return f"{type(e).__name__}: {e}"
+
+class FilaEmails:
+    """Envia o que está em emails_pendentes por uma conexão SMTP reaproveitada.
+
+    Tudo que fala com o smtplib roda numa thread só (a conexão não é thread-safe).
+    Cada lote é reservado com um UPDATE ... RETURNING que empurra proxima_tentativa
+    para frente: dois processos da API nunca pegam a mesma mensagem, e se um cair no
+    meio do lote, a reserva vence e outro manda. A reserva dura o tempo do lote no ritmo
+    configurado mais uma folga, e nada é mandado depois que a folga começa: o que sobrar
+    (servidor lento) volta para a fila em vez de correr o risco de sair duas vezes.
+    """
+
+    def __init__(self, host: str, port: int, usar_ssl: bool, remetente: Optional[str], senha: Optional[str],
+                 lote: int, por_minuto: float, max_tentativas: int, intervalo: float, ocioso: float):
+        self.host = host
+        self.port = port
+        self.usar_ssl = usar_ssl
+        self.remetente = remetente
+        self.senha = senha
+        self.lote = lote
+        self.por_minuto = por_minuto
+        self.max_tentativas = max_tentativas
+        self.intervalo = intervalo
+        self.ocioso = ocioso
+        self.enviados = 0
+        self.impressos = 0  # sem SMTP configurado: o código só foi para o log
+        self.falhas = 0
+        self.desistencias = 0
+        self.conexoes = 0
+        self.ultimo_erro = None
+        self._smtp = None
+        self._usado_em = 0.0
+        self._proximo_envio = 0.0
+        self._acordar = asyncio.Event()
+        self._executor = None
+        self._tarefa = None
+        self._lote_atual = None
+
+    # --- Lado SMTP (sempre na thread da fila) ---
+    def _conectar(self):
+        if self.usar_ssl:
+            # Burlar verificação SSL local para não travar no computador de desenvolvimento
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            smtp = smtplib.SMTP_SSL(self.host, self.port, context=context, timeout=SMTP_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        if self.senha: smtp.login(self.remetente, self.senha)
+        self.conexoes += 1
+        return smtp
 
-    try:
-        # Burlar verificação SSL local para não travar no computador de desenvolvimento
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-            server.login(remetente, senha)
-            server.sendmail(remetente, destinatario, msg.as_string())
-            print(f"E-mail de verificação enviado para {destinatario}")
-    except Exception as e:
-        print(f"Erro ao enviar email: {e}")
+    def _fechar_smtp(self, educado=True):
+        if self._smtp is None: return
+        try:
+            if educado: self._smtp.quit()
+            else: self._smtp.close()
+        except Exception: pass
+        self._smtp = None
+
+    def _enviar_sync(self, destinatario, assunto, corpo):
+        msg = MIMEMultipart()
+        msg['From'] = self.remetente
+        msg['To'] = destinatario
+        msg['Subject'] = assunto
+        msg.attach(MIMEText(corpo, 'plain'))
+        while True:
+            reaproveitada = self._smtp is not None
+            if self._smtp is None: self._smtp = self._conectar()
+            try:
+                self._smtp.sendmail(self.remetente, destinatario, msg.as_string())
+                self._usado_em = time.monotonic()
+                return
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                raise  # o servidor respondeu (e o sendmail já deu RSET): a conexão continua boa
+            except Exception as e:
+                self._fechar_smtp(educado=False)
+                # A conexão guardada pode ter caído do lado do servidor: tenta uma vez com uma nova
+                if not (reaproveitada and isinstance(e, smtplib.SMTPServerDisconnected)): raise
+
+    # --- Lado da fila (event loop) ---
+    def duracao_reserva(self):
+        """Segundos que um lote fica reservado: o lote inteiro no ritmo por_minuto, mais a folga."""
+        return self.lote * 60 / self.por_minuto + EMAIL_RESERVA_FOLGA
+
+    async def _reservar(self, client, reservado_ate):
+        agora = time.time()
+        res = await client.execute(
+            "UPDATE emails_pendentes SET tentativas = tentativas + 1, proxima_tentativa = ? "
+            "WHERE id IN (SELECT id FROM emails_pendentes WHERE proxima_tentativa <= ? ORDER BY proxima_tentativa LIMIT ?) "
+            "RETURNING id, destinatario, assunto, corpo, tentativas",
+            [reservado_ate, agora, self.lote])
+        return res.rows
+
+    async def _aguardar_vez(self):
+        espera = self._proximo_envio - time.monotonic()
+        if espera > 0: await asyncio.sleep(espera)
+        self._proximo_envio = max(self._proximo_envio, time.monotonic()) + 60 / self.por_minuto
+
+    async def enviar_lote(self):
+        """Reserva e envia um lote; o resultado de todas as mensagens é gravado num batch só.
+
+        Retorna quantas mensagens foram reservadas.
+        """
+        reservado_ate = time.time() + self.duracao_reserva()
+        async with db_pool.conexao() as client:
+            mensagens = await self._reservar(client, reservado_ate)
+        if not mensagens: return 0
+        loop = asyncio.get_running_loop()
+        enviados, devolvidos, statements = [], [], []
+        for id_, destinatario, assunto, corpo, tentativas in mensagens:
+            if not self.remetente:
+                # Não foi enviado: fica na tabela como desistência, com o motivo, e não conta em enviados
+                print(f"AVISO: Email não configurado no .env. Mensagem para {destinatario}:\n{corpo}")
+                self.impressos += 1
+                statements.append(libsql_client.Statement(
+                    "UPDATE emails_pendentes SET proxima_tentativa = NULL, ultimo_erro = ? WHERE id = ?",
+                    ["SMTP não configurado: mensagem só impressa no log", id_]))
+                continue
+            await self._aguardar_vez()
+            if time.time() > reservado_ate - EMAIL_RESERVA_FOLGA:
+                devolvidos.append(id_)
+                continue
+            try:
+                await loop.run_in_executor(self._executor, self._enviar_sync, destinatario, assunto, corpo)
+                enviados.append(id_)
+                self.enviados += 1
+            except Exception as e:
+                self.falhas += 1
+                self.ultimo_erro = resumir_erro(e)
+                if erro_permanente(e) or tentativas >= self.max_tentativas:
+                    self.desistencias += 1
+                    proxima = None
+                    print(f"AVISO: Desistindo do e-mail para {destinatario} depois de {tentativas} tentativas ({e}).")
+                else:
+                    proxima = time.time() + min(60 * 2 ** (tentativas - 1), 3600)
+                statements.append(libsql_client.Statement(
+                    "UPDATE emails_pendentes SET proxima_tentativa = ?, ultimo_erro = ? WHERE id = ?", [proxima, str(e), id_]))
+        if enviados:
+            marcadores = ", ".join("?" * len(enviados))
+            statements.append(libsql_client.Statement(f"DELETE FROM emails_pendentes WHERE id IN ({marcadores})", enviados))
+        if devolvidos:
+            # A reserva ia vencer antes do envio: volta para a fila agora, sem gastar tentativa
+            marcadores = ", ".join("?" * len(devolvidos))
+            statements.append(libsql_client.Statement(
+                "UPDATE emails_pendentes SET tentativas = tentativas - 1, proxima_tentativa = ? "
+                f"WHERE id IN ({marcadores}) AND proxima_tentativa = ?", [time.time(), *devolvidos, reservado_ate]))
+        async with db_pool.conexao() as client:
+            await client.batch(statements)
+        return len(mensagens)
+
+    async def _laco(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try: await asyncio.wait_for(self._acordar.wait(), timeout=self.intervalo)
+            except asyncio.TimeoutError: pass
+            self._acordar.clear()
+            try:
+                # Lote cheio = provavelmente tem mais (rajada de cadastros): segue sem esperar o próximo ciclo.
+                # shield: desligar no meio do lote espera ele terminar em vez de deixar mensagens reservadas.
+                while True:
+                    self._lote_atual = asyncio.create_task(self.enviar_lote())
+                    if await asyncio.shield(self._lote_atual) < self.lote: break
+            except Exception as e:
+                self.ultimo_erro = resumir_erro(e)
+                print(f"AVISO: Falha na fila de e-mails ({e}).")
+            if self._smtp is not None and time.monotonic() - self._usado_em > self.ocioso:
+                await loop.run_in_executor(self._executor, self._fechar_smtp)
+
+    def acordar(self):
+        self._acordar.set()
+
+    def iniciar(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="emails")
+        self._tarefa = asyncio.create_task(self._laco())
+        self.acordar()  # o que ficou pendente antes de reiniciar sai logo
+
+    async def parar(self):
+        if self._tarefa is None: return
+        self._tarefa.cancel()
+        try: await self._tarefa
+        except asyncio.CancelledError: pass
+        self._tarefa = None
+        if self._lote_atual is not None: await asyncio.gather(self._lote_atual, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._fechar_smtp)
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "enviados": self.enviados, "impressos": self.impressos, "falhas": self.falhas, "desistencias": self.desistencias,
+            "conexoes_smtp": self.conexoes, "conectado": self._smtp is not None, "ultimo_erro": self.ultimo_erro
+        }
+
+fila_emails = FilaEmails(SMTP_HOST, SMTP_PORT, SMTP_SSL, SMTP_EMAIL, SMTP_PASSWORD, EMAIL_LOTE,
+                         EMAIL_POR_MINUTO, EMAIL_MAX_TENTATIVAS, EMAIL_INTERVALO, EMAIL_OCIOSO)
+
+# Cadastro e login não usam o get_db: o bcrypt pode esperar na fila do pool_hash, e segurar um
+# cliente do banco durante essa espera esgotaria o db_pool com poucos logins simultâneos.
+# O cliente é emprestado só para a consulta e para a escrita, e o hash roda sem nenhum em mãos.
 
 @app.post("/auth/register")
-async def register_user(user: UserCreate, background_tasks: BackgroundTasks):
-    client = get_db_client()
-    try:
+async def register_user(user: UserCreate):
+    async with db_pool.conexao() as client:
         check = await client.execute("SELECT id FROM usuarios WHERE email = ?", [user.email])
-        if check.rows: raise HTTPException(status_code=400, detail="Email já cadastrado.")
-        
-        hashed_pwd = get_password_hash(user.password)
-        # Gera código de 6 dígitos aleatório
-        codigo_verificacao = ''.join(random.choices(string.digits, k=6))
-        
-        res = await client.execute(
-            "INSERT INTO usuarios (email, senha, usar_banco_padrao, is_verified, verification_code) VALUES (?, ?, 1, 0, ?)",
-            [user.email, hashed_pwd, codigo_verificacao]
-        )
-        
-        # Envia o email em "segundo plano" para a tela do usuário não ficar travada carregando
-        background_tasks.add_task(enviar_email_verificacao, user.email, codigo_verificacao)
-        
-        return {"message": "Usuário criado. Verifique o seu e-mail.", "email": user.email}
-    finally: await client.close()
+    if check.rows: raise HTTPException(status_code=400, detail="Email já cadastrado.")
+    
+    hashed_pwd = await get_password_hash_async(user.password)
+    # Gera código de 6 dígitos aleatório
+    codigo_verificacao = ''.join(random.choices(string.digits, k=6))
+    assunto, corpo = montar_email_verificacao(codigo_verificacao)
+    
+    # O e-mail entra na fila na mesma transação do usuário: se a conta existe, o código vai ser enviado
+    async with db_pool.conexao() as client:
+        try:
+            await client.batch([
+                libsql_client.Statement(
+                    "INSERT INTO usuarios (email, senha, usar_banco_padrao, is_verified, verification_code) VALUES (?, ?, 1, 0, ?)",
+                    [user.email, hashed_pwd, codigo_verificacao]),
+                libsql_client.Statement(
+                    "INSERT INTO emails_pendentes (destinatario, assunto, corpo, proxima_tentativa, criado_em) VALUES (?, ?, ?, ?, ?)",
+                    [user.email, assunto, corpo, time.time(), datetime.utcnow().isoformat(timespec="seconds")]),
+            ])
+        except libsql_client.LibsqlError as e:
+            # Outro cadastro com o mesmo e-mail entrou enquanto o hash era calculado
+            if "UNIQUE" in str(e): raise HTTPException(status_code=400, detail="Email já cadastrado.")
+            raise
+    fila_emails.acordar()
+    
+    return {"message": "Usuário criado. Verifique o seu e-mail.", "email": user.email}
 
 class VerifyRequest(BaseModel):
     email: str
     codigo: str
 
 @app.post("/auth/verify")
-async def verify_email(req: VerifyRequest):
-    client = get_db_client()
-    try:
-        res = await client.execute("SELECT id, verification_code FROM usuarios WHERE email = ?", [req.email])
-        if not res.rows: raise HTTPException(status_code=404, detail="Usuário não encontrado.")
-        
-        user_id = res.rows[0][0]
-        code_db = res.rows[0][1]
+async def verify_email(req: VerifyRequest, client: libsql_client.Client = Depends(get_db)):
+    res = await client.execute("SELECT id, verification_code FROM usuarios WHERE email = ?", [req.email])
+    if not res.rows: raise HTTPException(status_code=404, detail="Usuário não encontrado.")
+    
+    user_id = res.rows[0][0]
+    code_db = res.rows[0][1]
+    
+    if code_db != req.codigo.strip():
+        raise HTTPException(status_code=400, detail="Código inválido ou expirado.")
         
-        if code_db != req.codigo.strip():
-            raise HTTPException(status_code=400, detail="Código inválido ou expirado.")
-            
-        await client.execute("UPDATE usuarios SET is_verified = 1, verification_code = NULL WHERE id = ?", [user_id])
-        return {"message": "Email verificado com sucesso! Já pode fazer o login."}
-    finally: await client.close()
+    await client.execute("UPDATE usuarios SET is_verified = 1, verification_code = NULL WHERE id = ?", [user_id])
+    cache_usuarios.invalidar(user_id)
+    return {"message": "Email verificado com sucesso! Já pode fazer o login."}
 
 @app.post("/auth/login", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    client = get_db_client()
-    try:
+    async with db_pool.conexao() as client:
         result = await client.execute("SELECT id, senha, is_verified FROM usuarios WHERE email = ?", [form_data.username])
-        if not result.rows: raise HTTPException(status_code=401, detail="Email ou senha incorretos")
-        
-        user_db = result.rows[0]
-        user_id = user_db[0]
-        hashed_pwd = user_db[1]
-        is_verified = user_db[2]
-        
-        if not verify_password(form_data.password, hashed_pwd):
-            raise HTTPException(status_code=401, detail="Email ou senha incorretos")
-            
-        if not is_verified:
-            raise HTTPException(status_code=403, detail="E-mail não verificado. Procure o código na sua caixa de entrada.")
+    if not result.rows: raise HTTPException(status_code=401, detail="Email ou senha incorretos")
+    
+    user_db = result.rows[0]
+    user_id = user_db[0]
+    hashed_pwd = user_db[1]
+    is_verified = user_db[2]
+    
+    if not await verify_password_async(form_data.password, hashed_pwd):
+        raise HTTPException(status_code=401, detail="Email ou senha incorretos")
         
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(data={"sub": str(user_id)}, expires_delta=access_token_expires)
-        return {"access_token": access_token, "token_type": "bearer"}
-    finally: await client.close()
+    if not is_verified:
+        raise HTTPException(status_code=403, detail="E-mail não verificado. Procure o código na sua caixa de entrada.")
+    
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(data={"sub": str(user_id)}, expires_delta=access_token_expires)
+    return {"access_token": access_token, "token_type": "bearer"}
 
 
 
@@ -291,9 +1003,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 # ==========================================================
 
 @app.get("/equipe")
-async def get_equipe(apenas_ativos: bool = True, current_user: dict = Depends(get_current_user)):
+async def get_equipe(apenas_ativos: bool = True, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     """Retorna apenas os membros vinculados ao usuário logado."""
-    client = get_db_client()
     try:
         user_id = current_user["id"]
         query = '''
@@ -316,73 +1027,92 @@ async def get_equipe(apenas_ativos: bool = True, current_user: dict = Depends(ge
             })
         return {"equipe": equipe}
     except Exception as e: return {"error": str(e)}
-    finally: await client.close()
+
+def vincular_funcoes_por_nome(membro_id_sql, params_membro, funcoes, user_id):
+    """INSERT ... SELECT que resolve todos os nomes de função de uma vez e cria os vínculos.
+
+    O JOIN com membros garante que o membro é do usuário (senão nada é inserido). Quando o mesmo
+    nome (após TRIM) existe mais de uma vez para o usuário, vale o menor id, como no SELECT por nome.
+    """
+    nomes = list({f.strip() for f in funcoes})
+    marcadores = ", ".join("?" for _ in nomes)
+    return libsql_client.Statement(
+        f"INSERT OR IGNORE INTO membro_funcoes (membro_id, funcao_id) "
+        f"SELECT m.id, MIN(f.id) FROM membros m JOIN funcoes f ON f.usuario_id = m.usuario_id "
+        f"WHERE m.id = {membro_id_sql} AND m.usuario_id = ? AND TRIM(f.nome) IN ({marcadores}) GROUP BY TRIM(f.nome)",
+        params_membro + [user_id] + nomes
+    )
 
 @app.post("/equipe")
-async def add_membro(membro: MembroRequest, current_user: dict = Depends(get_current_user)):
-    client = get_db_client()
+async def add_membro(membro: MembroRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
         user_id = current_user["id"]
-        res = await client.execute(
+        statements = [libsql_client.Statement(
             "INSERT INTO membros (nome, telefone, email, status, usuario_id) VALUES (?, ?, ?, ?, ?)",
             [membro.nome, membro.telefone, membro.email, membro.status, user_id]
-        )
-        membro_id = res.last_insert_rowid
-        
-        for f in membro.funcoes:
-            f_res = await client.execute("SELECT id FROM funcoes WHERE TRIM(nome) = ? AND usuario_id = ?", [f.strip(), user_id])
-            if f_res.rows:
-                await client.execute("INSERT INTO membro_funcoes (membro_id, funcao_id) VALUES (?, ?)", [membro_id, f_res.rows[0][0]])
-        return {"message": "Membro adicionado com sucesso!", "id": membro_id}
+        )]
+        if membro.funcoes:
+            # Dentro da transação do batch ninguém mais escreve, então o maior id do usuário é o membro recém-criado
+            # (last_insert_rowid() não serve: muda a cada linha inserida pelo próprio INSERT ... SELECT)
+            statements.append(vincular_funcoes_por_nome("(SELECT MAX(id) FROM membros WHERE usuario_id = ?)", [user_id], membro.funcoes, user_id))
+        # Um round trip e uma transação: ou entra o membro com todas as funções, ou nada
+        res = await client.batch(statements)
+        return {"message": "Membro adicionado com sucesso!", "id": res[0].last_insert_rowid}
     except Exception as e: return {"error": str(e)}
-    finally: await client.close()
 
 @app.put("/equipe/{membro_id}")
-async def update_membro(membro_id: int, membro: MembroRequest, current_user: dict = Depends(get_current_user)):
-    client = get_db_client()
+async def update_membro(membro_id: int, membro: MembroRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
         user_id = current_user["id"]
-        check = await client.execute("SELECT id FROM membros WHERE id = ? AND usuario_id = ?", [membro_id, user_id])
-        if not check.rows: raise HTTPException(status_code=403, detail="Você não tem permissão para editar este membro.")
-
-        await client.execute(
-            "UPDATE membros SET nome = ?, telefone = ?, email = ?, status = ? WHERE id = ?",
-            [membro.nome, membro.telefone, membro.email, membro.status, membro_id]
-        )
-        
-        await client.execute("DELETE FROM membro_funcoes WHERE membro_id = ?", [membro_id])
-        for f in membro.funcoes:
-            f_res = await client.execute("SELECT id FROM funcoes WHERE TRIM(nome) = ? AND usuario_id = ?", [f.strip(), user_id])
-            if f_res.rows:
-                await client.execute("INSERT INTO membro_funcoes (membro_id, funcao_id) VALUES (?, ?)", [membro_id, f_res.rows[0][0]])
+        # A checagem de posse vai junto no batch: se o membro não é do usuário, nenhum comando afeta nada
+        statements = [
+            libsql_client.Statement(
+                "UPDATE membros SET nome = ?, telefone = ?, email = ?, status = ? WHERE id = ? AND usuario_id = ?",
+                [membro.nome, membro.telefone, membro.email, membro.status, membro_id, user_id]
+            ),
+            libsql_client.Statement(
+                "DELETE FROM membro_funcoes WHERE membro_id = ? AND EXISTS (SELECT 1 FROM membros WHERE id = ? AND usuario_id = ?)",
+                [membro_id, membro_id, user_id]
+            ),
+        ]
+        if membro.funcoes:
+            statements.append(vincular_funcoes_por_nome("?", [membro_id], membro.funcoes, user_id))
+        res = await client.batch(statements)
+        if res[0].rows_affected == 0: raise HTTPException(status_code=403, detail="Você não tem permissão para editar este membro.")
         return {"message": "Membro atualizado com sucesso!"}
     except Exception as e: return {"error": str(e)}
-    finally: await client.close()
 
 @app.delete("/equipe/{membro_id}")
-async def delete_membro(membro_id: int, current_user: dict = Depends(get_current_user)):
-    client = get_db_client()
+async def delete_membro(membro_id: int, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
         await client.execute("DELETE FROM membros WHERE id = ? AND usuario_id = ?", [membro_id, current_user["id"]])
         return {"message": "Membro excluído com sucesso!"}
     except Exception as e: return {"error": str(e)}
-    finally: await client.close()
 
 # --- ROTAS DE FUNÇÕES (CRUD MULTI-TENANT INTELIGENTE) ---
 
 @app.get("/funcoes")
-async def get_funcoes(current_user: dict = Depends(get_current_user)):
-    client = get_db_client()
+async def get_funcoes(current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
         result = await client.execute("SELECT id, TRIM(nome) FROM funcoes WHERE usuario_id = ? ORDER BY TRIM(nome)", [current_user["id"]])
         funcoes = [{"id": row[0], "nome": row[1]} for row in result.rows]
         return {"funcoes": funcoes}
     except Exception as e: return {"error": str(e)}
-    finally: await client.close()
+
+def vincular_membros_a_funcao(funcao_id, membros_ids, user_id):
+    """Um INSERT ... SELECT com só os vínculos que faltam, e só para membros e função do usuário."""
+    ids = list(set(membros_ids))
+    marcadores = ", ".join("?" for _ in ids)
+    return libsql_client.Statement(
+        f"INSERT INTO membro_funcoes (membro_id, funcao_id) "
+        f"SELECT m.id, f.id FROM membros m JOIN funcoes f ON f.id = ? AND f.usuario_id = m.usuario_id "
+        f"WHERE m.usuario_id = ? AND m.id IN ({marcadores}) "
+        f"AND NOT EXISTS (SELECT 1 FROM membro_funcoes mf WHERE mf.membro_id = m.id AND mf.funcao_id = f.id)",
+        [funcao_id, user_id] + ids
+    )
 
 @app.post("/funcoes")
-async def add_funcao(funcao: FuncaoRequest, current_user: dict = Depends(get_current_user)):
-    client = get_db_client()
+async def add_funcao(funcao: FuncaoRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
         user_id = current_user["id"]
         nome_limpo = funcao.nome.strip()
@@ -412,17 +1142,32 @@ async def add_funcao(funcao: FuncaoRequest, current_user: dict = Depends(get_cur
                 return {"error": "Falha de restrição de banco."}
         
         if funcao.membros_ids:
-            for m_id in funcao.membros_ids:
-                check_mf = await client.execute("SELECT * FROM membro_funcoes WHERE membro_id = ? AND funcao_id = ?", [m_id, funcao_id])
-                if not check_mf.rows:
-                    await client.execute("INSERT INTO membro_funcoes (membro_id, funcao_id) VALUES (?, ?)", [m_id, funcao_id])
+            await client.execute(vincular_membros_a_funcao(funcao_id, funcao.membros_ids, user_id))
         return {"message": "Função processada com sucesso!", "id": funcao_id}
     except Exception as e: return {"error": str(e)}
-    finally: await client.close()
+
+@app.put("/funcoes/{funcao_id}/membros")
+async def substituir_membros_funcao(funcao_id: int, req: MembrosFuncaoRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
+    """Troca o conjunto inteiro de membros de uma função: remove quem saiu, adiciona quem entrou."""
+    try:
+        user_id = current_user["id"]
+        ids = list(set(req.membros_ids))
+        marcadores = ", ".join("?" for _ in ids)
+        res = await client.batch([
+            libsql_client.Statement("SELECT id FROM funcoes WHERE id = ? AND usuario_id = ?", [funcao_id, user_id]),
+            libsql_client.Statement(
+                f"DELETE FROM membro_funcoes WHERE funcao_id = ? AND membro_id NOT IN ({marcadores}) "
+                f"AND EXISTS (SELECT 1 FROM funcoes WHERE id = ? AND usuario_id = ?)",
+                [funcao_id] + ids + [funcao_id, user_id]
+            ),
+            vincular_membros_a_funcao(funcao_id, ids, user_id),
+        ])
+        if not res[0].rows: raise HTTPException(status_code=403, detail="Você não tem permissão para editar esta função.")
+        return {"message": "Membros da função atualizados!", "removidos": res[1].rows_affected, "adicionados": res[2].rows_affected}
+    except Exception as e: return {"error": str(e)}
 
 @app.put("/funcoes/{funcao_id}")
-async def update_funcao(funcao_id: int, funcao: FuncaoRequest, current_user: dict = Depends(get_current_user)):
-    client = get_db_client()
+async def update_funcao(funcao_id: int, funcao: FuncaoRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
         nome_limpo = funcao.nome.strip()
         try:
@@ -432,19 +1177,16 @@ async def update_funcao(funcao_id: int, funcao: FuncaoRequest, current_user: dic
             await client.execute("UPDATE funcoes SET nome = ? WHERE id = ? AND usuario_id = ?", [nome_limpo + " ", funcao_id, current_user["id"]])
         return {"message": "Função atualizada!"}
     except Exception as e: return {"error": str(e)}
-    finally: await client.close()
 
 @app.delete("/funcoes/{funcao_id}")
-async def delete_funcao(funcao_id: int, current_user: dict = Depends(get_current_user)):
-    client = get_db_client()
+async def delete_funcao(funcao_id: int, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
         await client.execute("DELETE FROM funcoes WHERE id = ? AND usuario_id = ?", [funcao_id, current_user["id"]])
         return {"message": "Função excluída!"}
     except Exception as e: return {"error": str(e)}
-    finally: await client.close()
 
 # ==========================================================
-# CÓDIGO DO TRANSPOSITOR (Mantido Intacto)
+# CÓDIGO DO TRANSPOSITOR
 # ==========================================================
 
 MAPA_NOTAS = {
@@ -461,47 +1203,64 @@ EXPLICACAO_TEORICA = {
     "Cb": "Dó bemol (Cb) é enarmônica de Si (B)."
 }
 
+# Tabelas pré-calculadas: toda grafia de nota aceita pelas regexes é resolvida uma única vez,
+# na importação do módulo, em vez de varrer MAPA_NOTAS a cada acorde.
+_VALOR_POR_NOTA = {k.lower(): v for k, v in MAPA_NOTAS.items()}
+_EXPLICACAO_POR_NOTA = {k.lower(): v for k, v in EXPLICACAO_TEORICA.items()}
+
+def _resolver_grafia(nota_str):
+    """Regras de enarmonia (## e bb) para uma grafia. Retorna (nota_normalizada, explicacao, valor)."""
+    for sufixo, delta, nome in (("##", 2, "Duplo Sustenido"), ("bb", -2, "Duplo Bemol")):
+        if nota_str.endswith(sufixo):
+            valor_base = _VALOR_POR_NOTA.get(nota_str.replace(sufixo, "").lower())
+            if valor_base is not None:
+                nova_nota = MAPA_VALORES_NOTAS[(valor_base + delta) % 12]
+                return nova_nota, f"A nota {nota_str} é enarmônica de {nova_nota} ({nome}).", _VALOR_POR_NOTA[nova_nota.lower()]
+    return nota_str, None, _VALOR_POR_NOTA.get(nota_str.lower())
+
+# Letra (maiúscula ou minúscula, por causa do re.IGNORECASE da sequência) + todo acidente possível
+_GRAFIAS = [letra + acidente for letra in "ABCDEFGabcdefg" for acidente in ("", "#", "##", "b", "bb", "B", "BB", "bB", "Bb")]
+_TABELA_GRAFIAS = {g: _resolver_grafia(g) for g in _GRAFIAS}
+
+def _grafia(nota_str):
+    info = _TABELA_GRAFIAS.get(nota_str)
+    return info if info is not None else _resolver_grafia(nota_str)
+
+@lru_cache(maxsize=12)
+def _tabela_transposicao(semitons):
+    """Mapa grafia -> nota transposta para um deslocamento (0 a 11 semitons)."""
+    tabela = {}
+    for g in _GRAFIAS:
+        nota_normalizada, _, valor = _TABELA_GRAFIAS[g]
+        tabela[g] = nota_normalizada if valor is None else MAPA_VALORES_NOTAS[(valor + semitons) % 12]
+    return tabela
+
 def transpor_nota_individual(nota_str, semitons):
-    nota_key = next((key for key in MAPA_NOTAS if key.lower() == nota_str.lower()), None)
-    if not nota_key: return nota_str
-    
-    valor_original = MAPA_NOTAS[nota_key]
-    novo_valor = (valor_original + semitons + 12) % 12
-    return MAPA_VALORES_NOTAS[novo_valor]
+    valor_original = _VALOR_POR_NOTA.get(nota_str.lower())
+    if valor_original is None: return nota_str
+    return MAPA_VALORES_NOTAS[(valor_original + semitons) % 12]
 
 def normalizar_nota(nota_str, explicacoes_set=None):
-    if nota_str.endswith("##"):
-        base = nota_str.replace("##", "")
-        base_key = next((k for k in MAPA_NOTAS if k.lower() == base.lower()), None)
-        if base_key is not None:
-            valor_base = MAPA_NOTAS[base_key]
-            novo_valor = (valor_base + 2) % 12
-            nova_nota = MAPA_VALORES_NOTAS[novo_valor]
-            if explicacoes_set is not None:
-                explicacoes_set.add(f"A nota {nota_str} é enarmônica de {nova_nota} (Duplo Sustenido).")
-            return nova_nota
-
-    if nota_str.endswith("bb"):
-        base = nota_str.replace("bb", "")
-        base_key = next((k for k in MAPA_NOTAS if k.lower() == base.lower()), None)
-        if base_key is not None:
-            valor_base = MAPA_NOTAS[base_key]
-            novo_valor = (valor_base - 2 + 12) % 12
-            nova_nota = MAPA_VALORES_NOTAS[novo_valor]
-            if explicacoes_set is not None:
-                explicacoes_set.add(f"A nota {nota_str} é enarmônica de {nova_nota} (Duplo Bemol).")
-            return nova_nota
-            
-    return nota_str
+    nota_normalizada, explicacao, _ = _grafia(nota_str)
+    if explicacao and explicacoes_set is not None:
+        explicacoes_set.add(explicacao)
+    return nota_normalizada
+
+# Padrões compilados uma vez só
+RE_ACORDE_SEQUENCIA = re.compile(r"^([A-G](?:##|bb|#|b)?)(.*)", re.IGNORECASE)
+RE_PALAVRA_ACORDE = re.compile(r'^[A-G](?:##|bb|#|b)?(m|M|dim|aug|sus|add|maj|º|°|/|[-+])?(\d+)?(\(?[^)\s]*\)?)?(/[A-G](?:##|bb|#|b)?)?$')
+RE_ACORDE_CIFRA = re.compile(r'(^|[^A-Ga-g#b])([A-G](?:##|bb|#|b)?)([^A-G\s,.\n\/]*)?(\/[A-G](?:##|bb|#|b)?)?')
+RE_TEM_NOTA = re.compile(r'[A-G]')
 
 def transpor_acordes_sequencia(acordes_originais, acao, intervalo):
     intervalo_semitons = int(intervalo * 2)
     semitons_ajuste = intervalo_semitons if acao == 'Aumentar' else -intervalo_semitons
+    tabela = _tabela_transposicao(semitons_ajuste % 12)
     acordes_transpostos = []
     explicacoes_entrada = set()
     
     for acorde_original in acordes_originais:
-        match = re.match(r"^([A-G](?:##|bb|#|b)?)(.*)", acorde_original, re.IGNORECASE)
+        match = RE_ACORDE_SEQUENCIA.match(acorde_original)
         
         if not match:
             acordes_transpostos.append(f"{acorde_original}?")
@@ -511,11 +1270,11 @@ def transpor_acordes_sequencia(acordes_originais, acao, intervalo):
         nota_fundamental = normalizar_nota(nota_bruta, explicacoes_entrada)
         
         if nota_fundamental == nota_bruta:
-            nota_key = next((k for k in EXPLICACAO_TEORICA if k.lower() == nota_fundamental.lower()), None)
-            if nota_key:
-                explicacoes_entrada.add(EXPLICACAO_TEORICA[nota_key])
+            explicacao = _EXPLICACAO_POR_NOTA.get(nota_fundamental.lower())
+            if explicacao:
+                explicacoes_entrada.add(explicacao)
 
-        nova_fundamental = transpor_nota_individual(nota_fundamental, semitons_ajuste)
+        nova_fundamental = tabela[nota_bruta]
         
         if '/' in resto:
             partes = resto.split('/')
@@ -534,57 +1293,343 @@ def transpor_acordes_sequencia(acordes_originais, acao, intervalo):
 def is_chord_line(line):
     line = line.strip()
     if not line: return False
-    chord_pattern = re.compile(r'^[A-G](?:##|bb|#|b)?(m|M|dim|aug|sus|add|maj|º|°|/|[-+])?(\d+)?(\(?[^)\s]*\)?)?(/[A-G](?:##|bb|#|b)?)?$')
+    # Sem nenhuma letra de A a G não existe acorde possível na linha
+    if not RE_TEM_NOTA.search(line): return False
     words = line.replace('/:', '').replace('|', '').strip().split()
     if not words: return False
-    chord_count = sum(1 for word in words if chord_pattern.match(word))
+    chord_count = sum(1 for word in words if RE_PALAVRA_ACORDE.match(word))
     return (chord_count / len(words)) >= 0.5
 
+def substituir_acorde(match, tabela):
+    prefixo, nota, qualidade, baixo = match.groups()
+    novo_baixo = "/" + tabela[baixo[1:]] if baixo else ""
+    return f"{prefixo or ''}{tabela[nota]}{qualidade or ''}{novo_baixo}"
+
+def transpor_linha_acordes(linha, tabela):
+    """Troca cada acorde de uma linha já identificada como linha de acordes."""
+    return RE_ACORDE_CIFRA.sub(lambda match: substituir_acorde(match, tabela), linha)
+
+def calcular_semitons(acao, intervalo):
+    return int(intervalo * 2) * (1 if acao == 'Aumentar' else -1)
+
 def processar_cifra(texto_cifra, acao, intervalo):
-    semitons = int(intervalo * 2) * (1 if acao == 'Aumentar' else -1)
-    
-    padrao_acorde = r'(^|[^A-Ga-g#b])([A-G](?:##|bb|#|b)?)([^A-G\s,.\n\/]*)?(\/[A-G](?:##|bb|#|b)?)?'
-    
-    def replacer(match):
-        prefixo, nota, qualidade, baixo = match.groups()
-        prefixo = prefixo or ""
-        qualidade = qualidade or ""
-        
-        nota_norm = normalizar_nota(nota)
-        nova_nota = transpor_nota_individual(nota_norm, semitons)
-
-        novo_baixo = ""
-        if baixo:
-            nota_baixo = baixo.replace('/', '')
-            nota_baixo_norm = normalizar_nota(nota_baixo)
-            novo_baixo = "/" + transpor_nota_individual(nota_baixo_norm, semitons)
-        
-        return f"{prefixo}{nova_nota}{qualidade}{novo_baixo}"
+    semitons = calcular_semitons(acao, intervalo)
+    tabela = _tabela_transposicao(semitons % 12)
 
-    linhas = texto_cifra.split('\n')
+    # Refrões repetem as mesmas linhas: cada linha distinta é analisada uma vez só
+    linhas_processadas = {}
     linhas_finais = []
     
-    for linha in linhas:
-        if is_chord_line(linha):
-            linhas_finais.append(re.sub(padrao_acorde, replacer, linha))
-        else:
-            linhas_finais.append(linha)
+    for linha in texto_cifra.split('\n'):
+        nova_linha = linhas_processadas.get(linha)
+        if nova_linha is None:
+            nova_linha = transpor_linha_acordes(linha, tabela) if is_chord_line(linha) else linha
+            linhas_processadas[linha] = nova_linha
+        linhas_finais.append(nova_linha)
             
     return "\n".join(linhas_finais)
 
+# --- Cache de resultados (as equipes transpõem as mesmas músicas para os mesmos tons) ---
+TRANSPOSE_CACHE_BYTES = int(float(os.getenv("TRANSPOSE_CACHE_MB", "32")) * 1024 * 1024)
+
+class CacheTransposicao:
+    """LRU endereçado pelo conteúdo: sha256 da entrada + deslocamento líquido (semitons % 12).
+
+    O limite é o total de bytes guardados, não a quantidade de itens.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._itens = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def chave(tipo: str, semitons: int, conteudo: str) -> bytes:
+        h = hashlib.sha256(f"{tipo}:{semitons % 12}:".encode())
+        h.update(conteudo.encode("utf-8", "surrogatepass"))
+        return h.digest()
+
+    def get(self, chave):
+        item = self._itens.get(chave)
+        if item is None:
+            self.misses += 1
+            return None
+        self._itens.move_to_end(chave)
+        self.hits += 1
+        return item[0]
+
+    def set(self, chave, valor, tamanho: int):
+        # Um item maior que 1/4 do cache expulsaria quase tudo: não vale guardar
+        if tamanho > self.max_bytes // 4: return
+        antigo = self._itens.pop(chave, None)
+        if antigo is not None: self.bytes -= antigo[1]
+        self._itens[chave] = (valor, tamanho)
+        self.bytes += tamanho
+        while self.bytes > self.max_bytes:
+            _, (_, tamanho_removido) = self._itens.popitem(last=False)
+            self.bytes -= tamanho_removido
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "itens": len(self._itens), "bytes": self.bytes, "max_bytes": self.max_bytes,
+            "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+cache_transposicao = CacheTransposicao(TRANSPOSE_CACHE_BYTES)
+
+def chave_cifra(texto, acao, intervalo):
+    return cache_transposicao.chave("cifra", calcular_semitons(acao, intervalo), texto)
+
+def processar_cifra_com_cache(texto, acao, intervalo):
+    chave = chave_cifra(texto, acao, intervalo)
+    res = cache_transposicao.get(chave)
+    if res is None:
+        res = processar_cifra(texto, acao, intervalo)
+        cache_transposicao.set(chave, res, len(res.encode("utf-8", "surrogatepass")))
+    return res
+
+def transpor_sequencia_com_cache(acordes, acao, intervalo):
+    chave = cache_transposicao.chave("sequencia", calcular_semitons(acao, intervalo), json.dumps(acordes))
+    res = cache_transposicao.get(chave)
+    if res is None:
+        res = transpor_acordes_sequencia(acordes, acao, intervalo)
+        cache_transposicao.set(chave, res, sum(len(s.encode("utf-8", "surrogatepass")) for lista in res for s in lista))
+    transpostos, explicacoes = res
+    return list(transpostos), list(explicacoes)
+
+# --- Pool de processos para transposição em lote (trabalho de CPU fora do event loop) ---
+TRANSPOSE_WORKERS = int(os.getenv("TRANSPOSE_WORKERS", "0")) or os.cpu_count() or 1
+TRANSPOSE_BATCH_MAX = int(os.getenv("TRANSPOSE_BATCH_MAX", "500"))
+
+def transpor_lote_worker(itens):
+    """Roda dentro do processo filho. Cada item vira {"transposed_cifra": ...} ou {"error": ...}."""
+    resultados = []
+    for texto, acao, intervalo in itens:
+        try:
+            resultados.append({"transposed_cifra": processar_cifra(texto, acao, intervalo)})
+        except Exception as e:
+            resultados.append({"error": str(e)})
+    return resultados
+
+class PoolTransposicao:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def abrir(self):
+        # "spawn" evita herdar por fork as threads do bcrypt e o estado do event loop
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def executar(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def transpor_lote(self, itens):
+        """Divide o lote em pedaços (alguns por worker) e devolve os resultados na ordem original."""
+        if not itens: return []
+        tamanho_pedaco = max(1, -(-len(itens) // (self.workers * 4)))
+        pedacos = [itens[i:i + tamanho_pedaco] for i in range(0, len(itens), tamanho_pedaco)]
+        loop = asyncio.get_running_loop()
+        resultados = await asyncio.gather(*[loop.run_in_executor(self._executor, transpor_lote_worker, p) for p in pedacos])
+        return [r for pedaco in resultados for r in pedaco]
+
+    def fechar(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+pool_transposicao = PoolTransposicao(TRANSPOSE_WORKERS)
+
+# --- Cifra tokenizada: analisada uma vez, renderizada em qualquer tom ---
+def tokenizar_cifra(texto_cifra):
+    """Quebra a cifra em trechos de texto (str) e acordes (tupla nota, qualidade, baixo).
+
+    Usa exatamente is_chord_line e RE_ACORDE_CIFRA, então renderizar_cifra(tokens, tabela)
+    é idêntico a processar_cifra para qualquer deslocamento.
+    """
+    tokens = []
+    texto_pendente = []
+    for i, linha in enumerate(texto_cifra.split('\n')):
+        if i: texto_pendente.append('\n')
+        if not is_chord_line(linha):
+            texto_pendente.append(linha)
+            continue
+        pos = 0
+        for match in RE_ACORDE_CIFRA.finditer(linha):
+            prefixo, nota, qualidade, baixo = match.groups()
+            texto_pendente.append(linha[pos:match.start()] + (prefixo or ""))
+            tokens.append("".join(texto_pendente))
+            texto_pendente = []
+            tokens.append((nota, qualidade or "", baixo[1:] if baixo else ""))
+            pos = match.end()
+        texto_pendente.append(linha[pos:])
+    if texto_pendente:
+        tokens.append("".join(texto_pendente))
+    return [t for t in tokens if t != ""]
+
+def renderizar_cifra(tokens, tabela):
+    partes = []
+    for token in tokens:
+        if isinstance(token, str):
+            partes.append(token)
+        else:
+            nota, qualidade, baixo = token
+            partes.append(tabela[nota] + qualidade + ("/" + tabela[baixo] if baixo else ""))
+    return "".join(partes)
+
+def transpor_todos_os_tons(texto_cifra, semitons_lista=None):
+    tokens = tokenizar_cifra(texto_cifra)
+    # -1 e 11 são o mesmo tom: cada deslocamento é renderizado uma vez só, no máximo 12
+    semitons_lista = range(12) if semitons_lista is None else dict.fromkeys(s % 12 for s in semitons_lista)
+    return [{"semitons": s, "transposed_cifra": renderizar_cifra(tokens, _tabela_transposicao(s))} for s in semitons_lista]
+
+# Formato salvo no banco: {"v": versão, "tokens": [...]}, com texto como str e
+# cada acorde como [offset no texto original, nota, qualidade, baixo]
+VERSAO_TOKENS = 1
+
+def serializar_tokens(tokens):
+    saida, offset = [], 0
+    for token in tokens:
+        if isinstance(token, str):
+            saida.append(token)
+            offset += len(token)
+        else:
+            nota, qualidade, baixo = token
+            saida.append([offset, nota, qualidade, baixo])
+            offset += len(nota) + len(qualidade) + (1 + len(baixo) if baixo else 0)
+    return json.dumps({"v": VERSAO_TOKENS, "tokens": saida}, ensure_ascii=False)
+
+def desserializar_tokens(tokens_json, texto_original):
+    """Se o formato salvo for de outra versão do tokenizador, tokeniza de novo a partir do texto."""
+    dados = json.loads(tokens_json)
+    if dados.get("v") != VERSAO_TOKENS:
+        return tokenizar_cifra(texto_original)
+    return [t if isinstance(t, str) else (t[1], t[2], t[3]) for t in dados["tokens"]]
+
+# --- Transposição em streaming para arquivos de texto grandes ---
+STREAM_CHUNK_BYTES = int(os.getenv("STREAM_CHUNK_BYTES", str(64 * 1024)))
+STREAM_MAX_LINHA = int(os.getenv("STREAM_MAX_LINHA", str(64 * 1024)))
+
+async def transpor_arquivo_em_streaming(file: UploadFile, acao, intervalo):
+    """Lê o upload em pedaços e devolve linha a linha, com a mesma semântica de processar_cifra.
+
+    A memória fica limitada a um pedaço + uma linha. Uma "linha" maior que STREAM_MAX_LINHA
+    não é cifra: é repassada sem alteração até a próxima quebra.
+    """
+    tabela = _tabela_transposicao(calcular_semitons(acao, intervalo) % 12)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pendente = ""
+    repassando_linha_longa = False
+
+    def transpor(linha):
+        return transpor_linha_acordes(linha, tabela) if is_chord_line(linha) else linha
+
+    while True:
+        chunk = await file.read(STREAM_CHUNK_BYTES)
+        pendente += decoder.decode(chunk, final=not chunk)
+        *linhas, pendente = pendente.split('\n')
+        saida = []
+        for linha in linhas:
+            saida.append((linha if repassando_linha_longa else transpor(linha)) + '\n')
+            repassando_linha_longa = False
+        if len(pendente) > STREAM_MAX_LINHA:
+            saida.append(pendente)
+            pendente = ""
+            repassando_linha_longa = True
+        if saida: yield "".join(saida)
+        if not chunk: break
+
+    yield pendente if repassando_linha_longa else transpor(pendente)
+
+# --- Arquivos .docx (processados no pool, fora do event loop) ---
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+def extrair_texto_docx(content: bytes) -> str:
+    doc = docx.Document(io.BytesIO(content))
+    return "\n".join([p.text for p in doc.paragraphs])
+
+def _paragrafos_docx(doc):
+    """Parágrafos do corpo, das tabelas (inclusive aninhadas) e de cabeçalhos/rodapés."""
+    def das_tabelas(tabelas):
+        for tabela in tabelas:
+            for linha in tabela.rows:
+                for celula in linha.cells:
+                    yield from celula.paragraphs
+                    yield from das_tabelas(celula.tables)
+    yield from doc.paragraphs
+    yield from das_tabelas(doc.tables)
+    for secao in doc.sections:
+        for parte in (secao.header, secao.footer):
+            if not parte.is_linked_to_previous:
+                yield from parte.paragraphs
+                yield from das_tabelas(parte.tables)
+
+def transpor_paragrafo_docx(paragrafo, tabela):
+    """Transpõe os acordes dentro dos próprios runs, preservando a formatação de cada um.
+
+    Um acorde que atravessa vários runs fica inteiro no run onde começa.
+    """
+    runs = paragrafo.runs
+    textos = [run.text for run in runs]
+    texto = "".join(textos)
+    if not texto: return
+
+    trocas = []
+    inicio_linha = 0
+    for linha in texto.split('\n'):
+        if is_chord_line(linha):
+            for match in RE_ACORDE_CIFRA.finditer(linha):
+                novo = substituir_acorde(match, tabela)
+                if novo != match.group(0):
+                    trocas.append((inicio_linha + match.start(), inicio_linha + match.end(), novo))
+        inicio_linha += len(linha) + 1
+    if not trocas: return
+
+    inicios, pos = [], 0
+    for t in textos:
+        inicios.append(pos)
+        pos += len(t)
+    tamanhos = [len(t) for t in textos]
+
+    # De trás para frente: cada troca só altera posições >= ao seu início, então os offsets
+    # originais continuam válidos para as trocas anteriores
+    for ini, fim, novo in reversed(trocas):
+        primeiro = True
+        for k, a in enumerate(inicios):
+            b = a + tamanhos[k]
+            if b <= ini or a >= fim: continue
+            lo, hi = max(ini, a) - a, min(fim, b) - a
+            textos[k] = textos[k][:lo] + (novo if primeiro else "") + textos[k][hi:]
+            primeiro = False
+
+    for run, novo_texto in zip(runs, textos):
+        if run.text != novo_texto:
+            run.text = novo_texto
+
+def transpor_docx(content: bytes, acao, intervalo) -> bytes:
+    tabela = _tabela_transposicao(calcular_semitons(acao, intervalo) % 12)
+    doc = docx.Document(io.BytesIO(content))
+    for paragrafo in _paragrafos_docx(doc):
+        transpor_paragrafo_docx(paragrafo, tabela)
+    saida = io.BytesIO()
+    doc.save(saida)
+    return saida.getvalue()
+
 async def ler_conteudo_arquivo(file: UploadFile) -> str:
     content = await file.read()
     if file.filename.endswith('.docx'):
         try:
-            doc = docx.Document(io.BytesIO(content))
-            return "\n".join([p.text for p in doc.paragraphs])
+            return await pool_transposicao.executar(extrair_texto_docx, content)
         except Exception as e:
             return f"Erro ao ler arquivo .docx: {str(e)}"
     return content.decode("utf-8")
 
 @app.post("/transpose-sequence", response_model=TransposeSequenceResponse)
 async def transpose_sequence_endpoint(request: TransposeSequenceRequest):
-    transposed, expl = transpor_acordes_sequencia(request.chords, request.action, request.interval)
+    transposed, expl = transpor_sequencia_com_cache(request.chords, request.action, request.interval)
     return {
         "original_chords": request.chords,
         "transposed_chords": transposed,
@@ -593,15 +1638,64 @@ async def transpose_sequence_endpoint(request: TransposeSequenceRequest):
 
 @app.post("/transpose-text", response_model=TransposeCifraResponse)
 async def transpose_text_endpoint(request: TransposeCifraRequest):
-    res = processar_cifra(request.cifra_text, request.action, request.interval)
+    res = processar_cifra_com_cache(request.cifra_text, request.action, request.interval)
     return {"transposed_cifra": res}
 
 @app.post("/transpose-file", response_model=TransposeCifraResponse)
-async def transpose_file_endpoint(file: UploadFile = File(...), action: str = Form(...), interval: float = Form(...)):
+async def transpose_file_endpoint(file: UploadFile = File(...), action: str = Form(...), interval: float = Form(...), output: str = Form("text")):
+    # output="docx": devolve o próprio documento com os acordes trocados, mantendo a formatação
+    if output == "docx":
+        if not file.filename.endswith('.docx'):
+            raise HTTPException(status_code=400, detail="A saída .docx exige um arquivo .docx.")
+        try:
+            novo_docx = await pool_transposicao.executar(transpor_docx, await file.read(), action, interval)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Erro ao ler arquivo .docx: {str(e)}")
+        nome_saida = file.filename[:-len('.docx')] + "_transposto.docx"
+        return StreamingResponse(io.BytesIO(novo_docx), media_type=DOCX_MEDIA_TYPE,
+                                 headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(nome_saida)}"})
+
     texto = await ler_conteudo_arquivo(file)
-    res = processar_cifra(texto, action, interval)
+    res = processar_cifra_com_cache(texto, action, interval)
     return {"transposed_cifra": res}
 
+@app.post("/transpose-all-keys", response_model=TransposeAllKeysResponse)
+async def transpose_all_keys_endpoint(request: TransposeAllKeysRequest):
+    """Uma única análise da cifra, renderizada nos 12 tons (ou só nos deslocamentos pedidos)."""
+    return {"transposicoes": transpor_todos_os_tons(request.cifra_text, request.semitons)}
+
+@app.post("/transpose-file/stream")
+async def transpose_file_stream_endpoint(file: UploadFile = File(...), action: str = Form(...), interval: float = Form(...)):
+    """Versão em streaming de /transpose-file para cifras em texto puro."""
+    if file.filename.endswith('.docx'):
+        raise HTTPException(status_code=400, detail="O modo streaming aceita apenas arquivos de texto.")
+    return StreamingResponse(transpor_arquivo_em_streaming(file, action, interval), media_type="text/plain; charset=utf-8")
+
+@app.post("/transpose-batch", response_model=TransposeBatchResponse, response_model_exclude_none=True)
+async def transpose_batch_endpoint(request: TransposeBatchRequest):
+    """Transpõe um repertório inteiro numa chamada só; cada cifra tem a sua ação e intervalo."""
+    if len(request.itens) > TRANSPOSE_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"Máximo de {TRANSPOSE_BATCH_MAX} cifras por lote.")
+    resultados = [None] * len(request.itens)
+    chaves, pendentes = {}, []
+    for i, item in enumerate(request.itens):
+        try:
+            chaves[i] = chave_cifra(item.cifra_text, item.action, item.interval)
+        except Exception as e:
+            resultados[i] = {"error": str(e)}
+            continue
+        em_cache = cache_transposicao.get(chaves[i])
+        if em_cache is not None: resultados[i] = {"transposed_cifra": em_cache}
+        else: pendentes.append(i)
+
+    # Só o que não estava no cache vai para o pool de processos
+    itens = [(request.itens[i].cifra_text, request.itens[i].action, request.itens[i].interval) for i in pendentes]
+    for i, res in zip(pendentes, await pool_transposicao.transpor_lote(itens)):
+        resultados[i] = res
+        if "transposed_cifra" in res:
+            cache_transposicao.set(chaves[i], res["transposed_cifra"], len(res["transposed_cifra"].encode("utf-8", "surrogatepass")))
+    return {"resultados": resultados}
+
 # ==========================================================
 # ROTAS DO LEVIROBOTO (REPERTÓRIO E BUSCA MULTI-TENANT)
 # ==========================================================
@@ -609,105 +1703,590 @@ async def transpose_file_endpoint(file: UploadFile = File(...), action: str = Fo
 oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="/auth/login", auto_error=False)
 
 async def get_optional_user(token: Optional[str] = Depends(oauth2_scheme_optional)):
-    """Permite que visitantes usem o bot sem token, mas identifica quem está logado."""
+    """Permite que visitantes usem o bot sem token, mas identifica quem está logado.
+
+    Só empresta um cliente do pool quando o usuário não está no cache: visitante e
+    cache quente não tocam no banco.
+    """
     if not token: return None
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None: return None
         
-        client = get_db_client()
-        result = await client.execute("SELECT id, email, usar_banco_padrao FROM usuarios WHERE id = ?", [user_id])
-        await client.close()
-        
-        if not result.rows: return None
-        user = result.rows[0]
-        return {"id": user[0], "email": user[1], "usar_banco_padrao": user[2]}
+        user = cache_usuarios.get(user_id)
+        if user is not None: return user
+        async with db_pool.conexao() as client:
+            return await carregar_usuario(client, user_id)
     except:
         return None
 
+# --- Índice invertido de busca, um por tenant (None = banco padrão, compartilhado) ---
+# BUSCA_MODO=memoria carrega o repertório do tenant e busca em Python;
+# BUSCA_MODO=fts deixa a busca e o ranking com o FTS5 do banco e só traz os primeiros resultados.
+BUSCA_MODO = os.getenv("BUSCA_MODO", "memoria").lower()
+BUSCA_INDICE_TTL = float(os.getenv("BUSCA_INDICE_TTL", "300"))
+BUSCA_MAX_TENANTS = int(os.getenv("BUSCA_MAX_TENANTS", "200"))
+
+def separar_tags(tags_str):
+    return [t.strip().lower() for t in (tags_str or "").split(',')]
+
+def _ngramas(texto, n):
+    return {texto[i:i + n] for i in range(len(texto) - n + 1)}
+
+class IndiceFuzzy:
+    """Tags agrupadas por tamanho, com um bitset por (tamanho, letra, ocorrência da letra): o
+    closest_word da busca sem passar o SequenceMatcher pelo vocabulário inteiro.
+
+    O resultado é o mesmo do difflib.get_close_matches(q, vocabulario, n=1, cutoff): ratio() do
+    SequenceMatcher, corte em `cutoff` e, no empate, a maior string. O que muda é quem chega ao
+    ratio(). 2 * letras_em_comum / (len(q) + len(tag)) é um limite superior dele (o quick_ratio do
+    difflib), e as letras em comum de todas as tags de um tamanho saem de uma soma bit a bit dos
+    bitsets das letras da busca. As faixas (tamanho, letras em comum) são visitadas do maior limite
+    para o menor, e a busca para quando o limite fica abaixo do melhor ratio já achado: nenhuma
+    tag que o difflib escolheria fica de fora. Antes do ratio(), cada candidata ainda passa pela
+    maior subsequência comum (os blocos do SequenceMatcher são uma subsequência comum, então ela
+    também é limite superior), que descarta quase todas as tags de uma busca sem parecida.
+    """
+
+    MAX_CACHE = 2048
+
+    def __init__(self, cutoff=0.6):
+        self.cutoff = cutoff
+        self.tags = {}  # tag -> (tamanho, posição no grupo)
+        self._grupos = {}  # tamanho -> tags (None = posição livre)
+        self._livres = defaultdict(list)
+        self._bits = {}  # (tamanho, letra, ocorrência) -> bitset das posições
+        self._novos = defaultdict(list)  # posições ainda não gravadas no bitset (a montagem é em massa)
+        self._cache = {}
+
+    @staticmethod
+    def _fichas(texto):
+        # "amar" -> (a, 1), (a, 2), (m, 1), (r, 1): as fichas em comum são as letras em comum do quick_ratio
+        return [(letra, i) for letra, n in Counter(texto).items() for i in range(1, n + 1)]
+
+    def _bitset(self, chave):
+        bits = self._bits.get(chave, 0)
+        novos = self._novos.pop(chave, None)
+        if novos:
+            tamanho = max(bits.bit_length(), max(novos) + 1)
+            buffer = bytearray(bits.to_bytes((tamanho + 7) // 8, "little"))
+            for p in novos: buffer[p >> 3] |= 1 << (p & 7)
+            bits = self._bits[chave] = int.from_bytes(buffer, "little")
+        return bits
+
+    def preparar(self):
+        """Grava as posições pendentes em todos os bitsets (depois de uma carga em massa)."""
+        for chave in list(self._novos): self._bitset(chave)
+
+    def adicionar(self, tag):
+        if tag in self.tags: return
+        tamanho = len(tag)
+        grupo = self._grupos.setdefault(tamanho, [])
+        if self._livres[tamanho]:
+            posicao = self._livres[tamanho].pop()
+            grupo[posicao] = tag
+        else:
+            posicao = len(grupo)
+            grupo.append(tag)
+        for ficha in self._fichas(tag):
+            self._novos[(tamanho, *ficha)].append(posicao)
+        self.tags[tag] = (tamanho, posicao)
+        self._cache.clear()
+
+    def remover(self, tag):
+        lugar = self.tags.pop(tag, None)
+        if lugar is None: return
+        tamanho, posicao = lugar
+        for ficha in self._fichas(tag):
+            chave = (tamanho, *ficha)
+            self._bits[chave] = self._bitset(chave) & ~(1 << posicao)
+        self._grupos[tamanho][posicao] = None
+        self._livres[tamanho].append(posicao)
+        self._cache.clear()
+
+    def mais_proxima(self, palavra):
+        if palavra in self._cache: return self._cache[palavra]
+        resultado = self._calcular(palavra)
+        if len(self._cache) >= self.MAX_CACHE: self._cache.clear()
+        self._cache[palavra] = resultado
+        return resultado
+
+    @staticmethod
+    def _somar(bitsets):
+        """Contador bit a bit: a fatia i guarda o bit i da contagem de cada posição."""
+        fatias = []
+        for vai_um in bitsets:
+            i = 0
+            while vai_um:
+                if i == len(fatias):
+                    fatias.append(vai_um)
+                    break
+                fatias[i], vai_um = fatias[i] ^ vai_um, fatias[i] & vai_um
+                i += 1
+        return fatias
+
+    @staticmethod
+    def _pelo_menos(fatias, k):
+        """Posições cuja contagem é >= k (k >= 1), comparando do bit mais alto para o mais baixo."""
+        maior, igual = 0, -1
+        for i in range(max(len(fatias), k.bit_length()) - 1, -1, -1):
+            fatia = fatias[i] if i < len(fatias) else 0
+            if (k >> i) & 1: igual &= fatia
+            else:
+                maior |= igual & fatia
+                igual &= ~fatia
+        return maior | igual
+
+    @staticmethod
+    def _mascaras(palavra):
+        mascaras = {}
+        for i, letra in enumerate(palavra): mascaras[letra] = mascaras.get(letra, 0) | (1 << i)
+        return mascaras
+
+    @staticmethod
+    def _posicoes(bits):
+        texto = bin(bits)
+        ultimo = len(texto) - 1
+        i = texto.find("1", 2)
+        while i != -1:
+            yield ultimo - i
+            i = texto.find("1", i + 1)
+
+    def _calcular(self, palavra):
+        # ratio 1.0 só acontece com a própria palavra, e nenhum empate pode superá-la
+        if palavra in self.tags: return palavra
+        lq = len(palavra)
+        if lq == 0: return None
+        c = self.cutoff
+        fichas = self._fichas(palavra)
+        mascaras = self._mascaras(palavra)
+        todos = (1 << lq) - 1
+        # Faixas (limite, tamanho, letras em comum), começando pelo máximo possível de cada tamanho
+        faixas = []
+        for tamanho in self._grupos:
+            comuns = min(lq, tamanho)
+            limite = 2.0 * comuns / (lq + tamanho)
+            if limite >= c: faixas.append((-limite, tamanho, comuns))
+        heapq.heapify(faixas)
+
+        s = difflib.SequenceMatcher()
+        s.set_seq2(palavra)
+        melhor = None
+        contagens, vistos = {}, {}
+        while faixas:
+            limite, tamanho, comuns = heapq.heappop(faixas)
+            # Empate ainda pode ganhar (a maior string vence): só para quando o limite fica abaixo
+            if -limite < (melhor[0] if melhor else c): break
+            if tamanho not in contagens:
+                contagens[tamanho] = self._somar([self._bitset((tamanho, *f)) for f in fichas])
+                vistos[tamanho] = 0
+            novas = self._pelo_menos(contagens[tamanho], comuns) & ~vistos[tamanho]
+            vistos[tamanho] |= novas
+            grupo = self._grupos[tamanho]
+            for posicao in self._posicoes(novas):
+                tag = grupo[posicao]
+                # Maior subsequência comum, bit a bit (Hyyrö): os zeros de v são as letras casadas.
+                # Fica aqui dentro e não num método: é o laço mais quente da busca.
+                v = todos
+                for letra in tag:
+                    u = v & mascaras.get(letra, 0)
+                    v = ((v + u) | (v - u)) & todos
+                if 2.0 * (lq - bin(v).count("1")) / (lq + tamanho) < (melhor[0] if melhor else c): continue
+                s.set_seq1(tag)
+                razao = s.ratio()
+                if razao >= c and (melhor is None or (razao, tag) > melhor): melhor = (razao, tag)
+            if comuns > 1:
+                limite = 2.0 * (comuns - 1) / (lq + tamanho)
+                if limite >= c: heapq.heappush(faixas, (-limite, tamanho, comuns - 1))
+        return melhor[1] if melhor else None
+
+class IndiceMusicas:
+    """Tag exata -> músicas e n-gramas (1 a 3) do nome -> músicas.
+
+    Os n-gramas permitem responder "closest_word in nome" sem varrer o repertório:
+    só os candidatos que têm todos os trigramas da busca são conferidos.
+    """
+
+    def __init__(self):
+        self.musicas = {}
+        self.por_tag = defaultdict(set)
+        self.por_ngrama = defaultdict(set)
+        self.vocabulario = Counter()
+        self.fuzzy = IndiceFuzzy(cutoff=0.6)
+        self.carregado_em = time.monotonic()
+
+    def adicionar(self, musica_id, nome, tags_str, link):
+        self.remover(musica_id)
+        nome_lower = nome.lower()
+        tags = set(separar_tags(tags_str))
+        resultado_str = f"{nome}: {link}" if link else nome
+        self.musicas[musica_id] = (nome_lower, tags, resultado_str)
+        for tag in tags:
+            self.por_tag[tag].add(musica_id)
+            if tag:
+                self.vocabulario[tag] += 1
+                if self.vocabulario[tag] == 1: self.fuzzy.adicionar(tag)
+        for n in (1, 2, 3):
+            for ngrama in _ngramas(nome_lower, n):
+                self.por_ngrama[ngrama].add(musica_id)
+
+    def remover(self, musica_id):
+        antigo = self.musicas.pop(musica_id, None)
+        if antigo is None: return
+        nome_lower, tags, _ = antigo
+        for tag in tags:
+            self.por_tag[tag].discard(musica_id)
+            if not self.por_tag[tag]: del self.por_tag[tag]
+            if tag:
+                self.vocabulario[tag] -= 1
+                if self.vocabulario[tag] <= 0:
+                    del self.vocabulario[tag]
+                    self.fuzzy.remover(tag)
+        for n in (1, 2, 3):
+            for ngrama in _ngramas(nome_lower, n):
+                self.por_ngrama[ngrama].discard(musica_id)
+                if not self.por_ngrama[ngrama]: del self.por_ngrama[ngrama]
+
+    def _nomes_contendo(self, termo):
+        if not termo: return set(self.musicas)
+        if len(termo) <= 3: return set(self.por_ngrama.get(termo, ()))
+        listas = sorted((self.por_ngrama.get(g, set()) for g in _ngramas(termo, 3)), key=len)
+        candidatos = set(listas[0])
+        for lista in listas[1:]:
+            if not candidatos: break
+            candidatos &= lista
+        return {m for m in candidatos if termo in self.musicas[m][0]}
+
+    def palavra_mais_proxima(self, q_lower):
+        return self.fuzzy.mais_proxima(q_lower) or q_lower
+
+    def buscar(self, q, limite=10):
+        closest_word = self.palavra_mais_proxima(q.lower().strip())
+        encontrados = self.por_tag.get(closest_word, set()) | self._nomes_contendo(closest_word)
+        sorteados = random.sample(list(encontrados), min(limite, len(encontrados)))
+        return closest_word, [self.musicas[m][2] for m in sorteados]
+
+class GerenciadorIndices:
+    """Carrega cada índice sob demanda, compartilha entre requisições e recarrega após o TTL
+    (outros workers também escrevem no banco).
+
+    A montagem roda numa thread (asyncio.to_thread): num tenant grande ela leva segundos e
+    travaria o event loop. Só a primeira busca de um tenant espera por ela; depois do TTL a
+    busca segue respondendo com o índice antigo enquanto o novo é montado em segundo plano.
+    Cada tenant tem uma versão, que sobe a cada alteração incremental ou invalidar(): um
+    índice montado a partir de uma leitura anterior à alteração é descartado.
+    """
+
+    def __init__(self, ttl: float, max_tenants: int):
+        self.ttl = ttl
+        self.max_tenants = max_tenants
+        self._indices = OrderedDict()
+        self._locks = defaultdict(asyncio.Lock)
+        self._versoes = defaultdict(int)
+        self._recargas = {}
+        self.carregamentos = 0
+        self.descartados = 0
+        self.ultimo_erro = None
+
+    async def obter(self, client, tenant) -> IndiceMusicas:
+        indice = self._indices.get(tenant)
+        if indice is not None:
+            self._indices.move_to_end(tenant)
+            if time.monotonic() - indice.carregado_em >= self.ttl and tenant not in self._recargas:
+                self._recargas[tenant] = asyncio.create_task(self._recarregar(tenant))
+            return indice
+        async with self._locks[tenant]:
+            indice = self._indices.get(tenant)
+            if indice is None:
+                versao = self._versoes[tenant]
+                indice = await self._carregar(client, tenant)
+                # Alterado durante a montagem: serve assim mesmo, mas já vencido (a próxima busca recarrega)
+                if self._versoes[tenant] != versao: indice.carregado_em = float("-inf")
+                self._guardar(tenant, indice)
+            return indice
+
+    async def _carregar(self, client, tenant):
+        if tenant is None:
+            result = await client.execute("SELECT id, nome_musica, tags, link FROM biblioteca_busca WHERE usuario_id IS NULL")
+        else:
+            result = await client.execute("SELECT id, nome_musica, tags, link FROM biblioteca_busca WHERE usuario_id = ?", [tenant])
+        indice = await asyncio.to_thread(self._montar, result.rows)
+        self.carregamentos += 1
+        return indice
+
+    @staticmethod
+    def _montar(linhas):
+        indice = IndiceMusicas()
+        for row in linhas:
+            indice.adicionar(row[0], row[1], row[2], row[3])
+        indice.fuzzy.preparar()
+        return indice
+
+    async def _recarregar(self, tenant):
+        try:
+            versao = self._versoes[tenant]
+            async with db_pool.conexao() as client:
+                indice = await self._carregar(client, tenant)
+            if self._versoes[tenant] != versao:
+                self.descartados += 1  # o índice em uso já tem a alteração; a próxima busca tenta de novo
+            elif tenant in self._indices:
+                self._guardar(tenant, indice)
+        except Exception as e:
+            self.ultimo_erro = str(e)
+            print(f"AVISO: Falha ao recarregar o índice de busca ({e}). Seguindo com o anterior.")
+        finally:
+            self._recargas.pop(tenant, None)
+
+    def _guardar(self, tenant, indice):
+        self._indices[tenant] = indice
+        self._indices.move_to_end(tenant)
+        while len(self._indices) > self.max_tenants:
+            antigo, _ = self._indices.popitem(last=False)
+            self._locks.pop(antigo, None)
+            self._versoes.pop(antigo, None)
+
+    def carregado(self, tenant) -> Optional[IndiceMusicas]:
+        """Índice já em memória (para atualização incremental); None se ainda não foi carregado."""
+        self._versoes[tenant] += 1
+        return self._indices.get(tenant)
+
+    def invalidar(self, tenant):
+        """Descarta o índice (ex.: depois de uma importação em massa); a próxima busca recarrega."""
+        self._versoes[tenant] += 1
+        self._indices.pop(tenant, None)
+
+    async def parar(self):
+        for tarefa in list(self._recargas.values()): tarefa.cancel()
+        await asyncio.gather(*self._recargas.values(), return_exceptions=True)
+
+    def stats(self):
+        return {"tenants": len(self._indices), "carregamentos": self.carregamentos,
+                "recarregando": len(self._recargas), "descartados": self.descartados,
+                "musicas": sum(len(i.musicas) for i in self._indices.values()), "ultimo_erro": self.ultimo_erro}
+
+indices_busca = GerenciadorIndices(BUSCA_INDICE_TTL, BUSCA_MAX_TENANTS)
+
+def tenant_da_busca(current_user):
+    return None if not current_user or current_user["usar_banco_padrao"] == 1 else current_user["id"]
+
+# --- Caminho FTS5 ---
+BUSCA_FTS_LIMITE = 10
+BUSCA_FTS_MAX_VOCAB = 5000 # termos examinados por palavra na correção ortográfica
+BUSCA_FTS_MAX_SUGESTOES = 20 # candidatas conferidas no repertório do tenant por palavra
+
+def termos_da_busca(q):
+    """Palavras da busca como o tokenizer do FTS as enxerga: minúsculas e sem acento."""
+    sem_acento = "".join(ch for ch in unicodedata.normalize("NFKD", q.lower()) if not unicodedata.combining(ch))
+    return re.findall(r"\w+", sem_acento)
+
+def consulta_fts(termos):
+    # Cada palavra vira um prefixo entre aspas ("lou"* acha "louvor"); todas precisam aparecer
+    return " ".join('"' + t.replace('"', '""') + '"*' for t in termos)
+
+async def amostra_fts(client, tenant):
+    """Busca vazia (ou só pontuação): músicas sorteadas do tenant, como o modo memória faz.
+
+    Mesmo esquema do sortear_pessoal: conta, sorteia as posições sem repetir e busca
+    todas num batch só, pulando direto para cada uma com OFFSET.
+    """
+    res = await client.execute("SELECT COUNT(*) FROM biblioteca_busca WHERE usuario_id IS ?", [tenant])
+    total = res.rows[0][0]
+    if not total: return []
+    resultados = await client.batch([
+        libsql_client.Statement(
+            "SELECT nome_musica, link FROM biblioteca_busca WHERE usuario_id IS ? LIMIT 1 OFFSET ?", [tenant, posicao])
+        for posicao in random.sample(range(total), min(BUSCA_FTS_LIMITE, total))
+    ])
+    # Se alguém apagou músicas entre as duas consultas o OFFSET pode cair fora; essa posição só fica de fora
+    return [f"{r.rows[0][0]}: {r.rows[0][1]}" if r.rows[0][1] else r.rows[0][0] for r in resultados if r.rows]
+
+async def buscar_fts(client, tenant, termos):
+    if not termos: return await amostra_fts(client, tenant)
+    result = await client.execute("""
+        SELECT b.nome_musica, b.link FROM biblioteca_busca_fts f
+        JOIN biblioteca_busca b ON b.id = f.rowid
+        WHERE biblioteca_busca_fts MATCH ? AND f.usuario_id IS ?
+        ORDER BY f.rank LIMIT ?""", [consulta_fts(termos), tenant, BUSCA_FTS_LIMITE])
+    return [f"{nome}: {link}" if link else nome for nome, link in result.rows]
+
+async def corrigir_termo(client, tenant, termo):
+    """Termo do repertório do próprio tenant mais parecido com o digitado (só entre os de mesma inicial).
+
+    O fts5vocab é do índice inteiro, com as palavras de todos os tenants: ele só sugere as candidatas.
+    Cada uma é conferida com um MATCH filtrado pelo usuario_id (todas num batch só), e a sugestão é a
+    mais parecida que existe nas músicas do tenant. Assim a palavra de um tenant nunca aparece para outro.
+    """
+    inicial = termo[0]
+    result = await client.execute(
+        "SELECT term FROM biblioteca_busca_fts_vocab WHERE term >= ? AND term < ? LIMIT ?",
+        [inicial, chr(ord(inicial) + 1), BUSCA_FTS_MAX_VOCAB])
+    vocabulario = [row[0] for row in result.rows]
+    candidatas = difflib.get_close_matches(termo, vocabulario, n=BUSCA_FTS_MAX_SUGESTOES, cutoff=0.6)
+    if not candidatas: return termo
+    # O próprio termo como prefixo vem primeiro: se o tenant tem palavra começando por ele, não há o que corrigir
+    consultas = [consulta_fts([termo])] + ['"' + c.replace('"', '""') + '"' for c in candidatas]
+    existentes = await client.batch([
+        libsql_client.Statement(
+            "SELECT EXISTS (SELECT 1 FROM biblioteca_busca_fts WHERE biblioteca_busca_fts MATCH ? AND usuario_id IS ?)",
+            [consulta, tenant])
+        for consulta in consultas
+    ])
+    if existentes[0].rows[0][0]: return termo
+    return next((c for c, res in zip(candidatas, existentes[1:]) if res.rows[0][0]), termo)
+
+async def buscar_musicas_fts(client, tenant, q):
+    termos = termos_da_busca(q)
+    resultados = await buscar_fts(client, tenant, termos)
+    if not resultados and termos:
+        # Nada encontrado: tenta de novo com cada palavra trocada pela mais próxima do vocabulário
+        corrigidos = [await corrigir_termo(client, tenant, t) for t in termos]
+        if corrigidos != termos:
+            termos = corrigidos
+            resultados = await buscar_fts(client, tenant, termos)
+    return " ".join(termos), resultados
+
 @app.get("/musicas/buscar")
-async def buscar_musicas(q: str, current_user: Optional[dict] = Depends(get_optional_user)):
+async def buscar_musicas(q: str, current_user: Optional[dict] = Depends(get_optional_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
-        if not current_user or current_user["usar_banco_padrao"] == 1:
-            result = await client.execute("SELECT nome_musica, tags, link FROM biblioteca_busca WHERE usuario_id IS NULL")
-        else:
-            result = await client.execute("SELECT nome_musica, tags, link FROM biblioteca_busca WHERE usuario_id = ?", [current_user["id"]])
-        await client.close()
-        
-        q_lower = q.lower().strip()
-        todas_tags = set()
-        for row in result.rows:
-            tags = [t.strip().lower() for t in row[1].split(',') if t.strip()]
-            todas_tags.update(tags)
-            
-        closest_word = q_lower
-        matches = difflib.get_close_matches(q_lower, list(todas_tags), n=1, cutoff=0.6)
-        if matches: closest_word = matches[0]
-            
-        musicas_encontradas = []
-        for row in result.rows:
-            nome, tags_str, link = row[0], row[1], row[2]
-            tags = [t.strip().lower() for t in tags_str.split(',')]
-            if closest_word in tags or closest_word in nome.lower():
-                resultado_str = f"{nome}: {link}" if link else nome
-                musicas_encontradas.append(resultado_str)
-                
-        random.shuffle(musicas_encontradas)
-        return {"closest_word": closest_word, "resultados": musicas_encontradas[:10]}
+        if BUSCA_MODO == "fts":
+            closest_word, musicas_encontradas = await buscar_musicas_fts(client, tenant_da_busca(current_user), q)
+            return {"closest_word": closest_word, "resultados": musicas_encontradas}
+        indice = await indices_busca.obter(client, tenant_da_busca(current_user))
+        closest_word, musicas_encontradas = indice.buscar(q)
+        return {"closest_word": closest_word, "resultados": musicas_encontradas}
     except Exception as e:
         return {"error": str(e)}
 
+# --- Sorteio: uma ida ao banco por sorteio, sem ORDER BY RANDOM() (que ordena a categoria inteira) ---
+REPERTORIO_PADRAO_INTERVALO = float(os.getenv("REPERTORIO_PADRAO_INTERVALO", "600"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def formatar_musica(nome, link):
+    return f"{nome}: {link}" if link else nome
+
+async def sortear_padrao(client):
+    # O OFFSET aleatório é calculado no próprio SELECT: conta a categoria e pula direto para a linha
+    statements = [
+        (f"SELECT conteudo, link FROM {tabela} WHERE usuario_id IS NULL LIMIT 1 "
+         f"OFFSET (SELECT ABS(RANDOM() % MAX(COUNT(*), 1)) FROM {tabela} WHERE usuario_id IS NULL)")
+        for tabela in CATEGORIAS_PADRAO
+    ]
+    try:
+        resultados = await client.batch(statements)
+    except Exception:
+        return {tabela: "Erro ao buscar." for tabela in CATEGORIAS_PADRAO}
+    return {
+        tabela: formatar_musica(*res.rows[0]) if res.rows else "Nenhuma música cadastrada."
+        for tabela, res in zip(CATEGORIAS_PADRAO, resultados)
+    }
+
+async def sortear_pessoal(client, user_id):
+    # 1. Categorias do usuário já com o tamanho de cada uma (substitui o SELECT DISTINCT)
+    res_cats = await client.execute(
+        "SELECT categoria, COUNT(*) FROM biblioteca_busca WHERE usuario_id = ? AND categoria IS NOT NULL GROUP BY categoria",
+        [user_id])
+    categorias = [(cat, total) for cat, total in res_cats.rows if cat.strip() != ""]
+    if not categorias: return {}
+    # 2. Uma música de cada categoria, todas no mesmo batch, pulando para uma posição sorteada
+    resultados = await client.batch([
+        libsql_client.Statement(
+            "SELECT nome_musica, link FROM biblioteca_busca WHERE usuario_id = ? AND categoria = ? LIMIT 1 OFFSET ?",
+            [user_id, cat, random.randrange(total)])
+        for cat, total in categorias
+    ])
+    # Se alguém apagou músicas entre as duas consultas o OFFSET pode cair fora; a categoria só fica de fora
+    return {cat: formatar_musica(*res.rows[0]) for (cat, _), res in zip(categorias, resultados) if res.rows}
+
+class RepertorioPadrao:
+    """As 6 categorias do banco padrão em memória: o sorteio anônimo não vai ao banco.
+
+    Um laço em segundo plano recarrega tudo a cada `intervalo` segundos (um batch só)
+    ou logo depois de invalidar(). Enquanto nada foi carregado, o sorteio usa o banco.
+    """
+
+    def __init__(self, intervalo: float):
+        self.intervalo = intervalo
+        self.pools = None
+        self.carregado_em = None
+        self.carregamentos = 0
+        self.falhas = 0
+        self.ultimo_erro = None
+        self.duracao_ms = 0.0
+        self.sorteios = 0
+        self._acordar = asyncio.Event()
+        self._tarefa = None
+
+    async def carregar(self, client):
+        inicio = time.perf_counter()
+        resultados = await client.batch([f"SELECT conteudo, link FROM {tabela} WHERE usuario_id IS NULL" for tabela in CATEGORIAS_PADRAO])
+        self.pools = {tabela: tuple(formatar_musica(nome, link) for nome, link in res.rows)
+                      for tabela, res in zip(CATEGORIAS_PADRAO, resultados)}
+        self.duracao_ms = round((time.perf_counter() - inicio) * 1000, 1)
+        self.carregado_em = time.monotonic()
+        self.carregamentos += 1
+
+    async def recarregar(self):
+        try:
+            async with db_pool.conexao() as client:
+                await self.carregar(client)
+        except Exception as e:
+            # Mantém os pools antigos (se houver); o próximo ciclo tenta de novo
+            self.falhas += 1
+            self.ultimo_erro = str(e)
+            print(f"AVISO: Falha ao recarregar o repertório padrão ({e}).")
+
+    async def _laco(self):
+        while True:
+            try: await asyncio.wait_for(self._acordar.wait(), timeout=self.intervalo)
+            except asyncio.TimeoutError: pass
+            self._acordar.clear()
+            await self.recarregar()
+
+    async def iniciar(self):
+        await self.recarregar()
+        self._tarefa = asyncio.create_task(self._laco())
+
+    async def parar(self):
+        if self._tarefa is None: return
+        self._tarefa.cancel()
+        try: await self._tarefa
+        except asyncio.CancelledError: pass
+        self._tarefa = None
+
+    def invalidar(self):
+        self._acordar.set()
+
+    def sortear(self):
+        if self.pools is None: return None
+        self.sorteios += 1
+        return {tabela: random.choice(pool) if pool else "Nenhuma música cadastrada." for tabela, pool in self.pools.items()}
+
+    def stats(self):
+        return {
+            "carregado": self.pools is not None, "carregamentos": self.carregamentos, "falhas": self.falhas,
+            "ultimo_erro": self.ultimo_erro, "duracao_ms": self.duracao_ms, "sorteios": self.sorteios,
+            "idade_s": round(time.monotonic() - self.carregado_em, 1) if self.carregado_em else None,
+            "musicas": {tabela: len(pool) for tabela, pool in (self.pools or {}).items()}
+        }
+
+repertorio_padrao = RepertorioPadrao(REPERTORIO_PADRAO_INTERVALO)
+
 @app.get("/musicas/sortear")
 async def sortear_musica(current_user: Optional[dict] = Depends(get_optional_user)):
+    # Sem Depends(get_db): o sorteio do banco padrão sai da memória e não deve esperar por um cliente do pool
     try:
-        client = get_db_client()
-        
         # Se for visitante ou usar o banco padrão (Lógica Antiga Fixa)
         if not current_user or current_user["usar_banco_padrao"] == 1:
-            async def pegar_aleatoria(tabela):
-                try:
-                    res = await client.execute(f"SELECT conteudo, link FROM {tabela} WHERE usuario_id IS NULL ORDER BY RANDOM() LIMIT 1")
-                    if res.rows:
-                        nome, link = res.rows[0][0], res.rows[0][1]
-                        return f"{nome}: {link}" if link else nome
-                    return "Nenhuma música cadastrada."
-                except: return "Erro ao buscar."
-
-            resultado = {
-                "is_custom": False,
-                "agitadas1": await pegar_aleatoria("agitadas1"),
-                "agitadas2": await pegar_aleatoria("agitadas2"), 
-                "lentas1": await pegar_aleatoria("lentas1"),
-                "lentas2": await pegar_aleatoria("lentas2"),
-                "ceia": await pegar_aleatoria("ceia"),
-                "infantis": await pegar_aleatoria("infantis")
-            }
-            await client.close()
-            return resultado
-            
+            sorteio = repertorio_padrao.sortear()
+            if sorteio is None:
+                async with db_pool.conexao() as client:
+                    sorteio = await sortear_padrao(client)
+            return {"is_custom": False, **sorteio}
         # Se usar o Repertório Pessoal (Lógica Dinâmica)
-        else:
-            user_id = current_user["id"]
-            # 1. Pega todas as categorias únicas que o usuário criou
-            res_cats = await client.execute("SELECT DISTINCT categoria FROM biblioteca_busca WHERE usuario_id = ? AND categoria IS NOT NULL", [user_id])
-            categorias = [row[0] for row in res_cats.rows if row[0].strip() != ""]
-            
-            sorteio = {}
-            # 2. Sorteia 1 música de cada categoria do usuário
-            for cat in categorias:
-                res_musica = await client.execute(
-                    "SELECT nome_musica, link FROM biblioteca_busca WHERE usuario_id = ? AND categoria = ? ORDER BY RANDOM() LIMIT 1", 
-                    [user_id, cat]
-                )
-                if res_musica.rows:
-                    nome, link = res_musica.rows[0][0], res_musica.rows[0][1]
-                    sorteio[cat] = f"{nome}: {link}" if link else nome
-                    
-            await client.close()
-            return {"is_custom": True, "sorteio": sorteio}
-            
+        async with db_pool.conexao() as client:
+            return {"is_custom": True, "sorteio": await sortear_pessoal(client, current_user["id"])}
+    except HTTPException: raise
     except Exception as e:
         return {"error": str(e)}
 
@@ -717,10 +2296,8 @@ class ConfigRequest(BaseModel):
     funcoes_padrao: Optional[str] = None
 
 @app.put("/usuario/config")
-async def update_config(config: ConfigRequest, current_user: dict = Depends(get_current_user)):
+async def update_config(config: ConfigRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
-        
         if config.usar_banco_padrao is not None:
             val = 1 if config.usar_banco_padrao else 0
             await client.execute("UPDATE usuarios SET usar_banco_padrao = ? WHERE id = ?", [val, current_user["id"]])
@@ -728,17 +2305,15 @@ async def update_config(config: ConfigRequest, current_user: dict = Depends(get_
         if config.funcoes_padrao is not None:
             await client.execute("UPDATE usuarios SET funcoes_padrao = ? WHERE id = ?", [config.funcoes_padrao, current_user["id"]])
             
-        await client.close()
+        cache_usuarios.invalidar(current_user["id"])
         return {"message": "Configuração atualizada!"}
     except Exception as e: return {"error": str(e)}
 
 @app.get("/usuario/me")
-async def get_my_profile(current_user: dict = Depends(get_current_user)):
+async def get_my_profile(current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
         res = await client.execute("SELECT funcoes_padrao FROM usuarios WHERE id = ?", [current_user["id"]])
         padrao = res.rows[0][0] if res.rows and res.rows[0][0] else "Mídia,Voz e violão,Voz 1,Voz 2,Voz 3"
-        await client.close()
         
         return {
             "email": current_user["email"], 
@@ -754,28 +2329,23 @@ class CategoriaRequest(BaseModel):
     nome: str
 
 @app.get("/categorias")
-async def get_categorias(current_user: dict = Depends(get_current_user)):
+async def get_categorias(current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
         result = await client.execute("SELECT id, nome FROM categorias_repertorio WHERE usuario_id = ? ORDER BY nome", [current_user["id"]])
         categorias = [{"id": row[0], "nome": row[1]} for row in result.rows]
-        await client.close()
         return {"categorias": categorias}
     except Exception as e: return {"error": str(e)}
 
 @app.post("/categorias")
-async def add_categoria(req: CategoriaRequest, current_user: dict = Depends(get_current_user)):
+async def add_categoria(req: CategoriaRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
         await client.execute("INSERT INTO categorias_repertorio (nome, usuario_id) VALUES (?, ?)", [req.nome, current_user["id"]])
-        await client.close()
         return {"message": "Categoria criada!"}
     except Exception as e: return {"error": str(e)}
 
 @app.put("/categorias/{cat_id}")
-async def update_categoria(cat_id: int, req: CategoriaRequest, current_user: dict = Depends(get_current_user)):
+async def update_categoria(cat_id: int, req: CategoriaRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
         user_id = current_user["id"]
         
         # Pega o nome antigo para atualizar nas músicas que já usam essa categoria
@@ -786,14 +2356,12 @@ async def update_categoria(cat_id: int, req: CategoriaRequest, current_user: dic
         
         # Atualiza a categoria em si
         await client.execute("UPDATE categorias_repertorio SET nome = ? WHERE id = ? AND usuario_id = ?", [req.nome, cat_id, user_id])
-        await client.close()
         return {"message": "Categoria atualizada!"}
     except Exception as e: return {"error": str(e)}
 
 @app.delete("/categorias/{cat_id}")
-async def delete_categoria(cat_id: int, current_user: dict = Depends(get_current_user)):
+async def delete_categoria(cat_id: int, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
         user_id = current_user["id"]
         
         # Pega o nome antigo para tirar das músicas que usavam ela
@@ -804,7 +2372,6 @@ async def delete_categoria(cat_id: int, current_user: dict = Depends(get_current
 
         # Exclui a categoria
         await client.execute("DELETE FROM categorias_repertorio WHERE id = ? AND usuario_id = ?", [cat_id, user_id])
-        await client.close()
         return {"message": "Categoria excluída!"}
     except Exception as e: return {"error": str(e)}
 
@@ -822,65 +2389,460 @@ class EditaMusicaRequest(BaseModel):
     link: Optional[str] = ""
 
 @app.get("/musicas/custom")
-async def get_custom_musicas(current_user: dict = Depends(get_current_user)):
+async def get_custom_musicas(current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
         result = await client.execute("SELECT id, nome_musica, tags, categoria, link FROM biblioteca_busca WHERE usuario_id = ? ORDER BY nome_musica", [current_user["id"]])
         musicas = [{"id": r[0], "nome_musica": r[1], "tags": r[2], "categoria": r[3] or "Sem Categoria", "link": r[4] or ""} for r in result.rows]
-        await client.close()
         return {"musicas": musicas}
     except Exception as e: return {"error": str(e)}
 
 @app.post("/musicas/custom")
-async def add_custom_musica(musica: NovaMusicaRequest, current_user: dict = Depends(get_current_user)):
+async def add_custom_musica(musica: NovaMusicaRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
-        await client.execute(
+        res = await client.execute(
             "INSERT INTO biblioteca_busca (nome_musica, tags, usuario_id, link, categoria) VALUES (?, ?, ?, ?, ?)",
             [musica.nome_musica, musica.tags, current_user["id"], musica.link, musica.categoria]
         )
-        await client.close()
+        indice = indices_busca.carregado(current_user["id"])
+        if indice: indice.adicionar(res.last_insert_rowid, musica.nome_musica, musica.tags, musica.link)
         return {"message": "Música adicionada ao seu repertório!"}
     except Exception as e: return {"error": str(e)}
 
 @app.put("/musicas/custom/{musica_id}")
-async def update_custom_musica(musica_id: int, req: EditaMusicaRequest, current_user: dict = Depends(get_current_user)):
+async def update_custom_musica(musica_id: int, req: EditaMusicaRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
-        await client.execute(
+        res = await client.execute(
             "UPDATE biblioteca_busca SET nome_musica = ?, tags = ?, categoria = ?, link = ? WHERE id = ? AND usuario_id = ?",
             [req.nome_musica, req.tags, req.categoria, req.link, musica_id, current_user["id"]]
         )
-        await client.close()
+        indice = indices_busca.carregado(current_user["id"])
+        if indice and res.rows_affected: indice.adicionar(musica_id, req.nome_musica, req.tags, req.link)
         return {"message": "Música atualizada!"}
     except Exception as e: return {"error": str(e)}
 
 @app.delete("/musicas/custom/{musica_id}")
-async def delete_custom_musica(musica_id: int, current_user: dict = Depends(get_current_user)):
+async def delete_custom_musica(musica_id: int, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
     try:
-        client = get_db_client()
         await client.execute("DELETE FROM biblioteca_busca WHERE id = ? AND usuario_id = ?", [musica_id, current_user["id"]])
-        await client.close()
+        indice = indices_busca.carregado(current_user["id"])
+        if indice: indice.remover(musica_id)
         return {"message": "Música removida!"}
     except Exception as e: return {"error": str(e)}
 
+# --- Importação em massa (CSV ou JSON lines) ---
+IMPORT_LOTE = int(os.getenv("IMPORT_LOTE", "200"))
+IMPORT_MAX_ERROS = int(os.getenv("IMPORT_MAX_ERROS", "500")) # erros listados na resposta (o total é sempre contado)
+IMPORT_MAX_LINHAS_REGISTRO = 20
+CATEGORIA_PADRAO_IMPORT = "Sem Categoria"
+COLUNAS_IMPORT = {"nome": "nome_musica", "nome_musica": "nome_musica", "name": "nome_musica", "tags": "tags",
+                  "categoria": "categoria", "category": "categoria", "link": "link"}
+
+async def linhas_do_upload(file: UploadFile):
+    """Linhas do arquivo, lidas em pedaços de STREAM_CHUNK_BYTES (o upload nunca fica inteiro na memória)."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pendente = ""
+    while True:
+        chunk = await file.read(STREAM_CHUNK_BYTES)
+        pendente += decoder.decode(chunk, final=not chunk)
+        *linhas, pendente = pendente.split('\n')
+        for linha in linhas:
+            yield linha.rstrip('\r')
+        if not chunk: break
+    if pendente: yield pendente.rstrip('\r')
+
+class LeitorCSV:
+    """Monta registros CSV linha a linha: um campo entre aspas pode ter quebras de linha.
+
+    Se as aspas não fecham em IMPORT_MAX_LINHAS_REGISTRO linhas, é uma aspa perdida: a primeira
+    linha vira erro e as seguintes são lidas de novo (uma linha ruim não engole o resto do arquivo).
+    """
+
+    def __init__(self):
+        self.cabecalho = None
+        self.acumulado = [] # (número da linha, texto)
+
+    def alimentar(self, numero, linha):
+        fila, saida = deque([(numero, linha)]), []
+        while fila:
+            self.acumulado.append(fila.popleft())
+            registro = "\n".join(texto for _, texto in self.acumulado)
+            if registro.count('"') % 2:
+                if len(self.acumulado) < IMPORT_MAX_LINHAS_REGISTRO: continue
+                saida.append(self._descartar_primeira(fila))
+                continue
+            inicio = self.acumulado[0][0]
+            self.acumulado = []
+            if registro.strip():
+                item = self._interpretar(inicio, registro)
+                if item: saida.append(item)
+        return saida
+
+    def finalizar(self):
+        saida = []
+        while self.acumulado:
+            fila = deque()
+            saida.append(self._descartar_primeira(fila))
+            while fila: saida.extend(self.alimentar(*fila.popleft()))
+        return saida
+
+    def _descartar_primeira(self, fila):
+        (inicio, _), *resto = self.acumulado
+        self.acumulado = []
+        fila.extendleft(reversed(resto))
+        return inicio, ValueError("aspas não fechadas")
+
+    def _interpretar(self, inicio, registro):
+        campos = next(csv.reader([registro]))
+        if self.cabecalho is None:
+            nomes = [c.strip().lower() for c in campos]
+            conhecidas = [n in COLUNAS_IMPORT for n in nomes if n]
+            if not any(conhecidas):
+                self.cabecalho = ["nome_musica", "tags", "categoria", "link"] # sem cabeçalho: ordem fixa
+            else:
+                self.cabecalho = [COLUNAS_IMPORT.get(n) for n in nomes]
+                if all(conhecidas): return None
+                # Cabeçalho com coluna que não conhecemos: vira erro no relatório, não música
+                desconhecidas = ", ".join(n for n in nomes if n and n not in COLUNAS_IMPORT)
+                return inicio, ValueError(f"cabeçalho com colunas desconhecidas ({desconhecidas}); elas foram ignoradas")
+        return inicio, {col: valor for col, valor in zip(self.cabecalho, campos) if col}
+
+async def registros_csv(linhas):
+    """(número da linha, dict ou ValueError) para cada registro do CSV."""
+    leitor, numero = LeitorCSV(), 0
+    async for linha in linhas:
+        numero += 1
+        for item in leitor.alimentar(numero, linha): yield item
+    for item in leitor.finalizar(): yield item
+
+async def registros_jsonl(linhas):
+    numero = 0
+    async for linha in linhas:
+        numero += 1
+        if not linha.strip(): continue
+        try:
+            obj = json.loads(linha)
+            if not isinstance(obj, dict): raise ValueError("cada linha precisa ser um objeto JSON")
+            yield numero, {COLUNAS_IMPORT[k.lower()]: v for k, v in obj.items() if k.lower() in COLUNAS_IMPORT}
+        except ValueError as e:
+            yield numero, ValueError(f"JSON inválido: {e}")
+
+def validar_registro(registro):
+    """Normaliza um registro importado para (nome, tags, categoria, link) ou levanta ValueError."""
+    if isinstance(registro, Exception): raise registro
+    nome = str(registro.get("nome_musica") or "").strip()
+    if not nome: raise ValueError("nome da música é obrigatório")
+    tags = registro.get("tags") or ""
+    if isinstance(tags, list): tags = ",".join(str(t) for t in tags)
+    categoria = str(registro.get("categoria") or "").strip() or CATEGORIA_PADRAO_IMPORT
+    link = str(registro.get("link") or "").strip()
+    return nome, str(tags), categoria, link
+
+@app.post("/musicas/custom/import")
+async def importar_musicas(file: UploadFile = File(...), formato: Optional[str] = Form(None), tamanho_lote: Optional[int] = Form(None), current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
+    """Importa um repertório inteiro (CSV com cabeçalho nome,tags,categoria,link ou JSON lines).
+
+    Os nomes das colunas/campos também podem vir em inglês (name, category). Um CSV sem
+    cabeçalho é lido na ordem nome, tags, categoria, link.
+
+    Grava em lotes: cada lote é um batch (uma ida ao banco, uma transação) que também cria as
+    categorias que ainda não existem. Linhas inválidas entram no relatório e não impedem as demais.
+    """
+    try:
+        user_id = current_user["id"]
+        inicio = time.perf_counter()
+        formato = (formato or "").lower() or ("jsonl" if (file.filename or "").lower().endswith((".jsonl", ".ndjson", ".json")) else "csv")
+        if formato not in ("csv", "jsonl"): return {"error": "Formato deve ser 'csv' ou 'jsonl'."}
+        lote_max = max(1, min(tamanho_lote or IMPORT_LOTE, 1000))
+
+        res_cats = await client.execute("SELECT nome FROM categorias_repertorio WHERE usuario_id = ?", [user_id])
+        categorias = {row[0] for row in res_cats.rows}
+        erros, total_erros, importadas, linhas_lidas = [], 0, 0, 0
+
+        def registrar_erro(linha, mensagem):
+            nonlocal total_erros
+            total_erros += 1
+            if len(erros) < IMPORT_MAX_ERROS: erros.append({"linha": linha, "erro": mensagem})
+
+        async def gravar(lote):
+            nonlocal importadas
+            novas = sorted({cat for _, (_, _, cat, _) in lote} - categorias)
+            statements = [libsql_client.Statement("INSERT INTO categorias_repertorio (nome, usuario_id) VALUES (?, ?)", [cat, user_id]) for cat in novas]
+            statements += [libsql_client.Statement(
+                "INSERT INTO biblioteca_busca (nome_musica, tags, usuario_id, link, categoria) VALUES (?, ?, ?, ?, ?)",
+                [nome, tags, user_id, link, cat]) for _, (nome, tags, cat, link) in lote]
+            try:
+                await client.batch(statements)
+                categorias.update(novas)
+                importadas += len(lote)
+            except Exception as e:
+                for linha, _ in lote: registrar_erro(linha, f"Falha ao gravar o lote: {e}")
+
+        registros = (registros_csv if formato == "csv" else registros_jsonl)(linhas_do_upload(file))
+        lote = []
+        async for linha, registro in registros:
+            linhas_lidas += 1
+            try:
+                lote.append((linha, validar_registro(registro)))
+            except ValueError as e:
+                registrar_erro(linha, str(e))
+                continue
+            if len(lote) >= lote_max:
+                await gravar(lote)
+                lote = []
+        if lote: await gravar(lote)
+
+        if importadas: indices_busca.invalidar(user_id)
+        duracao = time.perf_counter() - inicio
+        return {
+            "message": f"{importadas} músicas importadas.", "importadas": importadas, "linhas": linhas_lidas,
+            "total_erros": total_erros, "erros": erros, "duracao_s": round(duracao, 3),
+            "linhas_por_segundo": round(linhas_lidas / duracao, 1) if duracao else None
+        }
+    except Exception as e: return {"error": str(e)}
+
+# ==========================================================
+# CIFRAS SALVAS (TRANSPOSIÇÃO POR ID SEM REPROCESSAR O TEXTO)
+# ==========================================================
+class CifraRequest(BaseModel):
+    titulo: str
+    cifra_text: str
+    musica_id: Optional[int] = None
+
+class TransposeCifraSalvaRequest(BaseModel):
+    action: str
+    interval: float
+
+async def validar_musica_da_cifra(client, musica_id, user_id):
+    """A cifra só pode apontar para uma música do próprio repertório ou do banco padrão."""
+    if musica_id is None: return True
+    res = await client.execute("SELECT id FROM biblioteca_busca WHERE id = ? AND (usuario_id = ? OR usuario_id IS NULL)", [musica_id, user_id])
+    return bool(res.rows)
+
+@app.get("/cifras")
+async def get_cifras(musica_id: Optional[int] = None, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
+    try:
+        query = "SELECT id, titulo, musica_id FROM cifras WHERE usuario_id = ?"
+        args = [current_user["id"]]
+        if musica_id is not None:
+            query += " AND musica_id = ?"
+            args.append(musica_id)
+        result = await client.execute(query + " ORDER BY titulo", args)
+        return {"cifras": [{"id": r[0], "titulo": r[1], "musica_id": r[2]} for r in result.rows]}
+    except Exception as e: return {"error": str(e)}
+
+@app.get("/cifras/{cifra_id}")
+async def get_cifra(cifra_id: int, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
+    try:
+        res = await client.execute("SELECT id, titulo, texto, musica_id FROM cifras WHERE id = ? AND usuario_id = ?", [cifra_id, current_user["id"]])
+        if not res.rows: raise HTTPException(status_code=404, detail="Cifra não encontrada.")
+        r = res.rows[0]
+        return {"id": r[0], "titulo": r[1], "cifra_text": r[2], "musica_id": r[3]}
+    except HTTPException: raise
+    except Exception as e: return {"error": str(e)}
+
+@app.post("/cifras")
+async def add_cifra(req: CifraRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
+    try:
+        if not await validar_musica_da_cifra(client, req.musica_id, current_user["id"]):
+            raise HTTPException(status_code=404, detail="Música não encontrada no seu repertório.")
+        tokens_json = serializar_tokens(tokenizar_cifra(req.cifra_text))
+        res = await client.execute(
+            "INSERT INTO cifras (titulo, texto, tokens, musica_id, usuario_id) VALUES (?, ?, ?, ?, ?)",
+            [req.titulo, req.cifra_text, tokens_json, req.musica_id, current_user["id"]]
+        )
+        return {"message": "Cifra salva!", "id": res.last_insert_rowid}
+    except HTTPException: raise
+    except Exception as e: return {"error": str(e)}
+
+@app.put("/cifras/{cifra_id}")
+async def update_cifra(cifra_id: int, req: CifraRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
+    try:
+        if not await validar_musica_da_cifra(client, req.musica_id, current_user["id"]):
+            raise HTTPException(status_code=404, detail="Música não encontrada no seu repertório.")
+        tokens_json = serializar_tokens(tokenizar_cifra(req.cifra_text))
+        res = await client.execute(
+            "UPDATE cifras SET titulo = ?, texto = ?, tokens = ?, musica_id = ? WHERE id = ? AND usuario_id = ?",
+            [req.titulo, req.cifra_text, tokens_json, req.musica_id, cifra_id, current_user["id"]]
+        )
+        if res.rows_affected == 0: raise HTTPException(status_code=404, detail="Cifra não encontrada.")
+        return {"message": "Cifra atualizada!"}
+    except HTTPException: raise
+    except Exception as e: return {"error": str(e)}
+
+@app.delete("/cifras/{cifra_id}")
+async def delete_cifra(cifra_id: int, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
+    try:
+        res = await client.execute("DELETE FROM cifras WHERE id = ? AND usuario_id = ?", [cifra_id, current_user["id"]])
+        if res.rows_affected == 0: raise HTTPException(status_code=404, detail="Cifra não encontrada.")
+        return {"message": "Cifra removida!"}
+    except HTTPException: raise
+    except Exception as e: return {"error": str(e)}
+
+@app.post("/cifras/{cifra_id}/transpose", response_model=TransposeCifraResponse)
+async def transpose_cifra_salva(cifra_id: int, req: TransposeCifraSalvaRequest, current_user: dict = Depends(get_current_user), client: libsql_client.Client = Depends(get_db)):
+    """Só troca os acordes já tokenizados: nada de detectar linhas ou rodar regex de novo."""
+    res = await client.execute("SELECT texto, tokens FROM cifras WHERE id = ? AND usuario_id = ?", [cifra_id, current_user["id"]])
+    if not res.rows: raise HTTPException(status_code=404, detail="Cifra não encontrada.")
+    tokens = desserializar_tokens(res.rows[0][1], res.rows[0][0])
+    tabela = _tabela_transposicao(calcular_semitons(req.action, req.interval) % 12)
+    return {"transposed_cifra": renderizar_cifra(tokens, tabela)}
+
+# --- Fila de sugestões (Google Sheets) ---
+# A rota só enfileira; um laço em segundo plano manda as linhas em lotes com append_rows,
+# reaproveitando o cliente gspread já autenticado. Com SUGESTOES_ARQUIVO definido, as linhas vão
+# para um CSV local no lugar da planilha (desenvolvimento e testes, sem credenciais do Google).
+SUGESTOES_PLANILHA = os.getenv("SUGESTOES_PLANILHA", "Sugestões de músicas LeviRoboto")
+SUGESTOES_ARQUIVO = os.getenv("SUGESTOES_ARQUIVO")
+SUGESTOES_LOTE = int(os.getenv("SUGESTOES_LOTE", "100"))
+SUGESTOES_ESPERA = float(os.getenv("SUGESTOES_ESPERA", "2"))  # segundos juntando linhas antes de enviar
+SUGESTOES_MAX_FILA = int(os.getenv("SUGESTOES_MAX_FILA", "10000"))
+SUGESTOES_BACKOFF_MAX = float(os.getenv("SUGESTOES_BACKOFF_MAX", "300"))
+
+class PlanilhaLocal:
+    """Substituta da planilha: mesmo append_rows do gspread, gravando num CSV."""
+
+    def __init__(self, caminho: str):
+        self.caminho = caminho
+
+    def append_rows(self, linhas):
+        with open(self.caminho, "a", newline="", encoding="utf-8") as arquivo:
+            csv.writer(arquivo).writerows(linhas)
+
+def abrir_planilha_sugestoes():
+    if SUGESTOES_ARQUIVO:
+        return PlanilhaLocal(SUGESTOES_ARQUIVO)
+    google_creds_env = os.getenv("GOOGLE_CREDENTIALS")
+    if google_creds_env:
+        gc = gspread.service_account_from_dict(json.loads(google_creds_env))
+    else:
+        gc = gspread.service_account(filename="credentials.json")
+    return gc.open(SUGESTOES_PLANILHA).sheet1
+
+class FilaSugestoes:
+    """Sugestões em memória até chegarem na planilha.
+
+    Uma thread só fala com o gspread (autentica e abre a planilha uma vez e reaproveita).
+    Se o envio falhar, as linhas voltam para a frente da fila, a planilha é reaberta na
+    próxima tentativa e a espera dobra a cada falha seguida (até `backoff_max`).
+    """
+
+    def __init__(self, abrir_planilha, lote: int, espera: float, max_fila: int, backoff_max: float):
+        self.abrir_planilha = abrir_planilha
+        self.lote = lote
+        self.espera = espera
+        self.max_fila = max_fila
+        self.backoff_max = backoff_max
+        self.fila = deque()
+        self.enviadas = 0
+        self.lotes = 0
+        self.descartadas = 0
+        self.falhas = 0
+        self.ultimo_erro = None
+        self._planilha = None
+        self._acordar = asyncio.Event()
+        self._executor = None
+        self._tarefa = None
+        self._envio = None
+
+    def enfileirar(self, usuario: str, sugestao: str) -> bool:
+        if len(self.fila) >= self.max_fila:
+            self.descartadas += 1
+            return False
+        self.fila.append([usuario, sugestao])
+        self._acordar.set()
+        return True
+
+    def _append_rows(self, linhas):
+        if self._planilha is None:
+            self._planilha = self.abrir_planilha()
+        self._planilha.append_rows(linhas)
+
+    async def enviar_pendentes(self):
+        """Esvazia a fila em lotes; erro sobe com as linhas do lote de volta na fila."""
+        while self.fila:
+            linhas = [self.fila.popleft() for _ in range(min(self.lote, len(self.fila)))]
+            try:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self._append_rows, linhas)
+            except Exception:
+                self.fila.extendleft(reversed(linhas))
+                raise
+            self.enviadas += len(linhas)
+            self.lotes += 1
+
+    async def _laco(self):
+        falhas_seguidas = 0
+        while True:
+            await self._acordar.wait()
+            self._acordar.clear()
+            await asyncio.sleep(self.espera)
+            try:
+                # shield: desligar no meio de um lote não pode devolver à fila linhas que a thread ainda vai enviar
+                self._envio = asyncio.create_task(self.enviar_pendentes())
+                await asyncio.shield(self._envio)
+                falhas_seguidas = 0
+            except Exception as e:
+                # Credencial expirada, cota do Google, rede: reabre a planilha e tenta de novo mais tarde
+                self._planilha = None
+                self.falhas += 1
+                self.ultimo_erro = str(e)
+                falhas_seguidas += 1
+                atraso = min(self.espera * 2 ** falhas_seguidas, self.backoff_max)
+                print(f"AVISO: Falha ao enviar {len(self.fila)} sugestões ({e}). Nova tentativa em {atraso:.0f}s.")
+                await asyncio.sleep(atraso)
+                self._acordar.set()
+
+    def iniciar(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sugestoes")
+        self._tarefa = asyncio.create_task(self._laco())
+
+    async def parar(self):
+        if self._tarefa is None: return
+        self._tarefa.cancel()
+        try: await self._tarefa
+        except asyncio.CancelledError: pass
+        self._tarefa = None
+        # Espera o lote em andamento e faz uma última tentativa para não perder o que chegou antes de desligar
+        if self._envio is not None: await asyncio.gather(self._envio, return_exceptions=True)
+        try: await self.enviar_pendentes()
+        except Exception as e: print(f"AVISO: {len(self.fila)} sugestões não enviadas ao desligar ({e}).")
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "pendentes": len(self.fila), "enviadas": self.enviadas, "lotes": self.lotes,
+            "descartadas": self.descartadas, "falhas": self.falhas, "ultimo_erro": self.ultimo_erro
+        }
+
+fila_sugestoes = FilaSugestoes(abrir_planilha_sugestoes, SUGESTOES_LOTE, SUGESTOES_ESPERA, SUGESTOES_MAX_FILA, SUGESTOES_BACKOFF_MAX)
+
 class SugestaoRequest(BaseModel):
     usuario: str
     sugestao: str
 
 @app.post("/musicas/sugerir")
 async def sugerir_musica(req: SugestaoRequest):
-    try:
-        google_creds_env = os.getenv("GOOGLE_CREDENTIALS")
-        if google_creds_env:
-            creds_dict = json.loads(google_creds_env)
-            gc = gspread.service_account_from_dict(creds_dict)
-        else:
-            gc = gspread.service_account(filename="credentials.json")
-        sh = gc.open("Sugestões de músicas LeviRoboto")
-        sh.sheet1.append_row([req.usuario, req.sugestao])
-        return {"message": "Sucesso"}
-    except Exception as e: return {"error": str(e)}
+    if not fila_sugestoes.enfileirar(req.usuario, req.sugestao):
+        return {"error": "Muitas sugestões pendentes. Tente novamente em alguns minutos."}
+    return {"message": "Sucesso"}
+
+# ==========================================================
+# MÉTRICAS INTERNAS (CACHES E POOLS)
+# ==========================================================
+
+@app.post("/repertorio-padrao/recarregar")
+async def recarregar_repertorio_padrao(x_admin_token: Optional[str] = Header(None)):
+    # Para quem alterou as tabelas padrão (ex.: migrar_repertorio.py) não esperar o próximo ciclo
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Acesso negado")
+    repertorio_padrao.invalidar()
+    return {"message": "Recarga do repertório padrão agendada."}
+
+@app.get("/metricas")
+async def get_metricas(x_admin_token: Optional[str] = Header(None)):
+    # Expõe tamanho dos caches, filas e últimos erros: só para quem opera a API
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Acesso negado")
+    return {"cache_usuarios": cache_usuarios.stats(), "pool_hash": pool_hash.stats(), "cache_transposicao": cache_transposicao.stats(), "indices_busca": indices_busca.stats(), "repertorio_padrao": repertorio_padrao.stats(), "fila_sugestoes": fila_sugestoes.stats(), "fila_emails": fila_emails.stats()}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,77 @@
+import difflib
+import random
+import statistics
+import time
+
+from api import IndiceFuzzy
+
+# Vocabulários sintéticos com "cara" de tags em português
+SILABAS = ["a", "ma", "mor", "de", "us", "gra", "ça", "lu", "vi", "da", "san", "to", "céu", "fé",
+           "je", "sus", "cru", "z", "pai", "lou", "vor", "glo", "ri", "a", "pra", "ze", "ção", "res"]
+TAMANHOS = [1_000, 10_000, 100_000]
+# O difflib é lento demais para o mesmo volume: ele roda só nas primeiras consultas (comparação e concordância)
+CONSULTAS_INDICE = 2_000
+CONSULTAS_DIFFLIB = {1_000: 200, 10_000: 100, 100_000: 30}
+
+def gerar_vocabulario(rnd, tamanho):
+    vocab = set()
+    while len(vocab) < tamanho:
+        palavra = "".join(rnd.choice(SILABAS) for _ in range(rnd.randint(2, 5)))
+        if rnd.random() < 0.15: palavra += " " + "".join(rnd.choice(SILABAS) for _ in range(rnd.randint(1, 3)))
+        vocab.add(palavra)
+    return list(vocab)
+
+def gerar_consulta(rnd, vocab):
+    """Mistura de buscas exatas, com erro de digitação e sem relação com o vocabulário."""
+    sorteio = rnd.random()
+    palavra = rnd.choice(vocab)
+    if sorteio < 0.3: return palavra
+    if sorteio < 0.8:
+        pos = rnd.randrange(len(palavra))
+        return palavra[:pos] + rnd.choice("aeioursd") + palavra[pos + 1:]
+    return "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(3, 9)))
+
+def baseline(q, vocab):
+    matches = difflib.get_close_matches(q, list(vocab), n=1, cutoff=0.6)
+    return matches[0] if matches else None
+
+def razao(q, tag):
+    return difflib.SequenceMatcher(None, q, tag).ratio() if tag else 0.0
+
+def resumo(tempos):
+    tempos = sorted(tempos)
+    p99 = tempos[max(0, int(len(tempos) * 0.99) - 1)]
+    return f"média {statistics.mean(tempos):8.3f} ms | p50 {statistics.median(tempos):8.3f} ms | p99 {p99:8.3f} ms"
+
+if __name__ == "__main__":
+    rnd = random.Random(7)
+    for tamanho in TAMANHOS:
+        vocab = gerar_vocabulario(rnd, tamanho)
+        inicio = time.perf_counter()
+        indice = IndiceFuzzy(cutoff=0.6)
+        for tag in vocab: indice.adicionar(tag)
+        indice.preparar()
+        construcao = time.perf_counter() - inicio
+
+        consultas = [gerar_consulta(rnd, vocab) for _ in range(CONSULTAS_INDICE)]
+        tempos_indice, obtidos = [], []
+        for q in consultas:
+            indice._cache.clear() # mede o cálculo, não o cache de consultas repetidas
+            inicio = time.perf_counter()
+            obtidos.append(indice.mais_proxima(q))
+            tempos_indice.append((time.perf_counter() - inicio) * 1000)
+
+        tempos_difflib, iguais, piores = [], 0, 0
+        for q, obtido in list(zip(consultas, obtidos))[:CONSULTAS_DIFFLIB[tamanho]]:
+            inicio = time.perf_counter()
+            esperado = baseline(q, vocab)
+            tempos_difflib.append((time.perf_counter() - inicio) * 1000)
+            if obtido == esperado: iguais += 1
+            elif razao(q, obtido) < razao(q, esperado): piores += 1
+
+        comparadas = len(tempos_difflib)
+        print(f"--- Vocabulário de {tamanho:,} tags (índice montado em {construcao:.2f}s) ---")
+        print(f"  difflib  {resumo(tempos_difflib)}  ({comparadas} consultas)")
+        print(f"  índice   {resumo(tempos_indice)}  ({len(consultas)} consultas)")
+        print(f"  mesmo resultado do difflib em {iguais}/{comparadas} ({100 * iguais / comparadas:.0f}%); "
+              f"{piores} com ratio menor, {comparadas - iguais - piores} empates com outra tag\n")
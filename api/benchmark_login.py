@@ -0,0 +1,57 @@
+import asyncio
+import statistics
+import time
+
+from api import get_password_hash, verify_password, PoolHash
+
+# Quantos logins simultâneos simular e de quanto em quanto tempo o "ticker" mede o event loop
+LOGINS_SIMULTANEOS = 8
+INTERVALO_TICK = 0.005
+
+async def medir_latencia_loop(parar: asyncio.Event, atrasos: list):
+    """Agenda um sleep curto em loop e anota quanto o event loop atrasou para acordá-lo."""
+    while not parar.is_set():
+        inicio = time.perf_counter()
+        await asyncio.sleep(INTERVALO_TICK)
+        atrasos.append((time.perf_counter() - inicio - INTERVALO_TICK) * 1000)
+
+async def login_bloqueante(hashed):
+    # Comportamento antigo: bcrypt roda direto dentro da rota async
+    verify_password("senha-de-teste", hashed)
+
+async def login_no_pool(pool: PoolHash, hashed):
+    await pool.executar(verify_password, "senha-de-teste", hashed)
+
+async def cenario(nome, fabrica_login):
+    parar = asyncio.Event()
+    atrasos = []
+    ticker = asyncio.create_task(medir_latencia_loop(parar, atrasos))
+    await asyncio.sleep(INTERVALO_TICK * 4)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*[fabrica_login() for _ in range(LOGINS_SIMULTANEOS)])
+    duracao = time.perf_counter() - inicio
+
+    parar.set()
+    await ticker
+    atrasos.sort()
+    p99 = atrasos[int(len(atrasos) * 0.99) - 1] if len(atrasos) > 1 else atrasos[0]
+    print(f"--- {nome} ---")
+    print(f"  {LOGINS_SIMULTANEOS} logins em {duracao:.2f}s")
+    print(f"  Atraso do event loop: mediana {statistics.median(atrasos):.1f} ms | p99 {p99:.1f} ms | máx {atrasos[-1]:.1f} ms\n")
+
+async def main():
+    print("Gerando hash de referência...")
+    hashed = get_password_hash("senha-de-teste")
+
+    await cenario("bcrypt no event loop (antes)", lambda: login_bloqueante(hashed))
+
+    pool = PoolHash(workers=2, max_fila=LOGINS_SIMULTANEOS * 2)
+    pool.abrir()
+    try:
+        await cenario("bcrypt no PoolHash (depois)", lambda: login_no_pool(pool, hashed))
+    finally:
+        pool.fechar()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import libsql_client
+
+from api import criar_estrutura_banco, sortear_padrao, sortear_pessoal, CATEGORIAS_PADRAO
+
+# Latência simulada de cada ida ao banco (o Turso fica do outro lado da rede; o arquivo local não)
+LATENCIA_MS = float(os.getenv("LATENCIA_MS", "40"))
+SORTEIOS = 30
+USUARIO_TESTE = 999_999
+MUSICAS_POR_CATEGORIA = 5_000
+CATEGORIAS_PESSOAIS = ["Entrada", "Louvor", "Adoração", "Ofertório", "Ceia", "Comunhão", "Final", "Infantil"]
+
+class ClienteComLatencia:
+    """Repassa para o cliente real, dormindo LATENCIA_MS a cada round trip."""
+
+    def __init__(self, client):
+        self.client = client
+        self.round_trips = 0
+
+    async def execute(self, *args, **kwargs):
+        self.round_trips += 1
+        await asyncio.sleep(LATENCIA_MS / 1000)
+        return await self.client.execute(*args, **kwargs)
+
+    async def batch(self, *args, **kwargs):
+        self.round_trips += 1
+        await asyncio.sleep(LATENCIA_MS / 1000)
+        return await self.client.batch(*args, **kwargs)
+
+# ==========================================================
+# IMPLEMENTAÇÃO ORIGINAL (UM ORDER BY RANDOM() POR CATEGORIA, EM SÉRIE)
+# ==========================================================
+
+async def legado_sortear_padrao(client):
+    async def pegar_aleatoria(tabela):
+        res = await client.execute(f"SELECT conteudo, link FROM {tabela} WHERE usuario_id IS NULL ORDER BY RANDOM() LIMIT 1")
+        if res.rows:
+            nome, link = res.rows[0][0], res.rows[0][1]
+            return f"{nome}: {link}" if link else nome
+        return "Nenhuma música cadastrada."
+    return {tabela: await pegar_aleatoria(tabela) for tabela in CATEGORIAS_PADRAO}
+
+async def legado_sortear_pessoal(client, user_id):
+    res_cats = await client.execute("SELECT DISTINCT categoria FROM biblioteca_busca WHERE usuario_id = ? AND categoria IS NOT NULL", [user_id])
+    categorias = [row[0] for row in res_cats.rows if row[0].strip() != ""]
+    sorteio = {}
+    for cat in categorias:
+        res_musica = await client.execute(
+            "SELECT nome_musica, link FROM biblioteca_busca WHERE usuario_id = ? AND categoria = ? ORDER BY RANDOM() LIMIT 1",
+            [user_id, cat])
+        if res_musica.rows:
+            nome, link = res_musica.rows[0][0], res_musica.rows[0][1]
+            sorteio[cat] = f"{nome}: {link}" if link else nome
+    return sorteio
+
+async def preparar_banco(caminho):
+    client = libsql_client.create_client(f"file://{caminho}")
+    await criar_estrutura_banco(client)
+    await client.execute("DELETE FROM biblioteca_busca WHERE usuario_id = ?", [USUARIO_TESTE])
+    await client.batch([
+        libsql_client.Statement(
+            "INSERT INTO biblioteca_busca (nome_musica, tags, usuario_id, link, categoria) VALUES (?, ?, ?, ?, ?)",
+            [f"{cat} {i}", "teste", USUARIO_TESTE, "", cat])
+        for cat in CATEGORIAS_PESSOAIS for i in range(MUSICAS_POR_CATEGORIA)
+    ])
+    return client
+
+async def cenario(titulo, client, legado, novo):
+    print(f"--- {titulo} ---")
+    for nome, fn in (("original", legado), ("novo", novo)):
+        lento = ClienteComLatencia(client)
+        tempos = []
+        for _ in range(SORTEIOS):
+            inicio = time.perf_counter()
+            resultado = await fn(lento)
+            tempos.append((time.perf_counter() - inicio) * 1000)
+        tempos.sort()
+        p99 = tempos[max(0, int(len(tempos) * 0.99) - 1)]
+        print(f"  {nome:<9} média {statistics.mean(tempos):7.1f} ms | p50 {statistics.median(tempos):7.1f} ms | "
+              f"p99 {p99:7.1f} ms | {lento.round_trips / SORTEIOS:.0f} round trips")
+    print(f"  categorias sorteadas: {sorted(resultado)}\n")
+
+async def main():
+    pasta = tempfile.mkdtemp()
+    caminho = os.path.join(pasta, "benchmark_sorteio.db")
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "musicas.db"), caminho)
+    client = await preparar_banco(caminho)
+    try:
+        print(f"Latência simulada por round trip: {LATENCIA_MS:.0f} ms | {SORTEIOS} sorteios por cenário\n")
+        await cenario("Banco padrão (6 tabelas)", client, legado_sortear_padrao, sortear_padrao)
+        await cenario(f"Repertório pessoal ({len(CATEGORIAS_PESSOAIS)} categorias x {MUSICAS_POR_CATEGORIA:,} músicas)", client,
+                      lambda c: legado_sortear_pessoal(c, USUARIO_TESTE), lambda c: sortear_pessoal(c, USUARIO_TESTE))
+    finally:
+        await client.close()
+        shutil.rmtree(pasta, ignore_errors=True)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,183 @@
+import random
+import re
+import time
+
+from api import MAPA_NOTAS, MAPA_VALORES_NOTAS, EXPLICACAO_TEORICA
+from api import processar_cifra, transpor_acordes_sequencia, transpor_todos_os_tons
+
+# ==========================================================
+# IMPLEMENTAÇÃO ORIGINAL (REFERÊNCIA PARA O TESTE DIFERENCIAL)
+# ==========================================================
+
+def legado_transpor_nota_individual(nota_str, semitons):
+    nota_key = next((key for key in MAPA_NOTAS if key.lower() == nota_str.lower()), None)
+    if not nota_key: return nota_str
+    valor_original = MAPA_NOTAS[nota_key]
+    novo_valor = (valor_original + semitons + 12) % 12
+    return MAPA_VALORES_NOTAS[novo_valor]
+
+def legado_normalizar_nota(nota_str, explicacoes_set=None):
+    if nota_str.endswith("##"):
+        base = nota_str.replace("##", "")
+        base_key = next((k for k in MAPA_NOTAS if k.lower() == base.lower()), None)
+        if base_key is not None:
+            nova_nota = MAPA_VALORES_NOTAS[(MAPA_NOTAS[base_key] + 2) % 12]
+            if explicacoes_set is not None:
+                explicacoes_set.add(f"A nota {nota_str} é enarmônica de {nova_nota} (Duplo Sustenido).")
+            return nova_nota
+    if nota_str.endswith("bb"):
+        base = nota_str.replace("bb", "")
+        base_key = next((k for k in MAPA_NOTAS if k.lower() == base.lower()), None)
+        if base_key is not None:
+            nova_nota = MAPA_VALORES_NOTAS[(MAPA_NOTAS[base_key] - 2 + 12) % 12]
+            if explicacoes_set is not None:
+                explicacoes_set.add(f"A nota {nota_str} é enarmônica de {nova_nota} (Duplo Bemol).")
+            return nova_nota
+    return nota_str
+
+def legado_transpor_acordes_sequencia(acordes_originais, acao, intervalo):
+    intervalo_semitons = int(intervalo * 2)
+    semitons_ajuste = intervalo_semitons if acao == 'Aumentar' else -intervalo_semitons
+    acordes_transpostos = []
+    explicacoes_entrada = set()
+    for acorde_original in acordes_originais:
+        match = re.match(r"^([A-G](?:##|bb|#|b)?)(.*)", acorde_original, re.IGNORECASE)
+        if not match:
+            acordes_transpostos.append(f"{acorde_original}?")
+            continue
+        nota_bruta, resto = match.groups()
+        nota_fundamental = legado_normalizar_nota(nota_bruta, explicacoes_entrada)
+        if nota_fundamental == nota_bruta:
+            nota_key = next((k for k in EXPLICACAO_TEORICA if k.lower() == nota_fundamental.lower()), None)
+            if nota_key:
+                explicacoes_entrada.add(EXPLICACAO_TEORICA[nota_key])
+        nova_fundamental = legado_transpor_nota_individual(nota_fundamental, semitons_ajuste)
+        if '/' in resto:
+            partes = resto.split('/')
+            baixo_normalizado = legado_normalizar_nota(partes[1], explicacoes_entrada)
+            novo_baixo = legado_transpor_nota_individual(baixo_normalizado, semitons_ajuste)
+            acorde_final = f"{nova_fundamental}{partes[0]}/{novo_baixo}"
+        else:
+            acorde_final = f"{nova_fundamental}{resto}"
+        acordes_transpostos.append(acorde_final)
+    return acordes_transpostos, list(explicacoes_entrada)
+
+def legado_is_chord_line(line):
+    line = line.strip()
+    if not line: return False
+    chord_pattern = re.compile(r'^[A-G](?:##|bb|#|b)?(m|M|dim|aug|sus|add|maj|º|°|/|[-+])?(\d+)?(\(?[^)\s]*\)?)?(/[A-G](?:##|bb|#|b)?)?$')
+    words = line.replace('/:', '').replace('|', '').strip().split()
+    if not words: return False
+    chord_count = sum(1 for word in words if chord_pattern.match(word))
+    return (chord_count / len(words)) >= 0.5
+
+def legado_processar_cifra(texto_cifra, acao, intervalo):
+    semitons = int(intervalo * 2) * (1 if acao == 'Aumentar' else -1)
+    padrao_acorde = r'(^|[^A-Ga-g#b])([A-G](?:##|bb|#|b)?)([^A-G\s,.\n\/]*)?(\/[A-G](?:##|bb|#|b)?)?'
+    def replacer(match):
+        prefixo, nota, qualidade, baixo = match.groups()
+        nova_nota = legado_transpor_nota_individual(legado_normalizar_nota(nota), semitons)
+        novo_baixo = ""
+        if baixo:
+            novo_baixo = "/" + legado_transpor_nota_individual(legado_normalizar_nota(baixo.replace('/', '')), semitons)
+        return f"{prefixo or ''}{nova_nota}{qualidade or ''}{novo_baixo}"
+    linhas_finais = []
+    for linha in texto_cifra.split('\n'):
+        linhas_finais.append(re.sub(padrao_acorde, replacer, linha) if legado_is_chord_line(linha) else linha)
+    return "\n".join(linhas_finais)
+
+# ==========================================================
+# CORPUS DE TESTE
+# ==========================================================
+
+LETRAS = ["A", "B", "C", "D", "E", "F", "G"]
+ACIDENTES = ["", "", "", "#", "b", "##", "bb"]
+QUALIDADES = ["", "", "m", "7", "m7", "maj7", "7M", "sus4", "add9", "dim", "º", "°", "aug", "m7(b5)", "7(9)", "4(9)", "-", "+", "9/", "6"]
+FRASES = [
+    "Santo, santo é o Senhor Deus", "Eu vou cantar ao meu Deus", "Aleluia, aleluia",
+    "E a Ele a glória", "Tom: G", "Intro: Am F C G", "[Refrão]", "Deus de Abraão, Isaque e Jacó",
+    "Bb é a nota", "Cb, Fb, E# e B# são enarmônicas", "Dó Ré Mi Fá", "", "   ", "|: C / G :|",
+]
+
+def acorde_aleatorio(rnd, minusculo=False):
+    letra = rnd.choice(LETRAS)
+    acidente = rnd.choice(ACIDENTES)
+    # A sequência usa re.IGNORECASE, então "c", "DB" e "ebB" também precisam bater
+    if minusculo and rnd.random() < 0.2: letra = letra.lower()
+    if minusculo and rnd.random() < 0.1: acidente = rnd.choice(["B", "BB", "bB", "Bb"])
+    acorde = letra + acidente + rnd.choice(QUALIDADES)
+    if rnd.random() < 0.2:
+        acorde += "/" + rnd.choice(LETRAS) + rnd.choice(ACIDENTES)
+    return acorde
+
+def gerar_cifra(rnd, linhas=40):
+    saida = []
+    for _ in range(linhas):
+        sorteio = rnd.random()
+        if sorteio < 0.45:
+            separadores = [" " * rnd.randint(1, 6) for _ in range(6)]
+            saida.append("".join(acorde_aleatorio(rnd) + s for s in separadores[: rnd.randint(1, 6)]).rstrip())
+        elif sorteio < 0.55:
+            saida.append(rnd.choice(FRASES) + " " + acorde_aleatorio(rnd))
+        else:
+            saida.append(rnd.choice(FRASES))
+    return "\n".join(saida)
+
+INTERVALOS = [i / 2 for i in range(0, 25)]
+
+def teste_diferencial(rnd, n_cifras=300):
+    divergencias = 0
+    for _ in range(n_cifras):
+        cifra = gerar_cifra(rnd)
+        acao, intervalo = rnd.choice(["Aumentar", "Diminuir"]), rnd.choice(INTERVALOS)
+        if processar_cifra(cifra, acao, intervalo) != legado_processar_cifra(cifra, acao, intervalo):
+            divergencias += 1
+            print(f"❌ processar_cifra divergiu ({acao} {intervalo}):\n{cifra}\n")
+
+        acordes = [acorde_aleatorio(rnd, minusculo=True) for _ in range(rnd.randint(1, 12))] + ["X", "h7", "", "C/", "C/E/G"]
+        if [r["transposed_cifra"] for r in transpor_todos_os_tons(cifra)] != [legado_processar_cifra(cifra, "Aumentar", s / 2) for s in range(12)]:
+            divergencias += 1
+            print(f"❌ transpor_todos_os_tons divergiu:\n{cifra}\n")
+
+        if transpor_acordes_sequencia(acordes, acao, intervalo) != legado_transpor_acordes_sequencia(acordes, acao, intervalo):
+            divergencias += 1
+            print(f"❌ transpor_acordes_sequencia divergiu ({acao} {intervalo}): {acordes}")
+    return divergencias
+
+def medir(nome, fn, cifras, repeticoes=3):
+    total_bytes = sum(len(c.encode("utf-8")) for c in cifras) * repeticoes
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        for i, cifra in enumerate(cifras):
+            fn(cifra, "Aumentar", (i % 12) / 2)
+    duracao = time.perf_counter() - inicio
+    print(f"  {nome:<12} {len(cifras) * repeticoes / duracao:>9.0f} cifras/s | {total_bytes / duracao / 1e6:.2f} MB/s")
+    return duracao
+
+if __name__ == "__main__":
+    rnd = random.Random(42)
+    print("🔍 Teste diferencial contra a implementação original...")
+    divergencias = teste_diferencial(rnd)
+    if divergencias:
+        print(f"❌ {divergencias} divergências encontradas.")
+        raise SystemExit(1)
+    print("✅ Saídas idênticas em todo o corpus.\n")
+
+    print("⏱️  Throughput de processar_cifra:")
+    cifras = [gerar_cifra(rnd, linhas=80) for _ in range(200)]
+    t_legado = medir("original", legado_processar_cifra, cifras)
+    t_novo = medir("tabelas", processar_cifra, cifras)
+    print(f"  Ganho: {t_legado / t_novo:.1f}x")
+
+    print("\n⏱️  Os 12 tons de uma cifra:")
+    inicio = time.perf_counter()
+    for cifra in cifras:
+        for s in range(12): processar_cifra(cifra, "Aumentar", s / 2)
+    t_doze = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    for cifra in cifras:
+        transpor_todos_os_tons(cifra)
+    t_unica = time.perf_counter() - inicio
+    print(f"  12 chamadas   {len(cifras) / t_doze:>9.0f} cifras/s")
+    print(f"  análise única {len(cifras) / t_unica:>9.0f} cifras/s")
+    print(f"  Ganho: {t_doze / t_unica:.1f}x")
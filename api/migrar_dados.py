@@ -1,86 +1,125 @@
-import os
+import argparse
 import asyncio
-import libsql_client
-from dotenv import load_dotenv
+import sys
+import time
 
-# Carrega as variáveis do seu arquivo .env (Onde estão o TURSO_URL e o TOKEN)
-load_dotenv()
+from api import get_db_client
 
-TURSO_URL = os.getenv("TURSO_DATABASE_URL")
-TURSO_TOKEN = os.getenv("TURSO_AUTH_TOKEN")
-
-# MUDE AQUI PARA O ID DO SEU NOVO UTILIZADOR SE NECESSÁRIO
-TARGET_USER_ID = 3
+# Transfere a posse de dados entre tenants (por padrão: dados órfãos, usuario_id IS NULL -> um usuário).
+# Sem --executar só mostra o relatório (dry-run). Com --executar, cada tabela é atualizada em pedaços
+# por faixa de rowid, um UPDATE (e uma transação) por pedaço: nada de lock longo no banco remoto,
+# e uma falha no meio deixa os pedaços anteriores gravados e os seguintes intactos (é só rodar de novo).
+# Uso: python migrar_dados.py --para 3                    -> relatório do que seria transferido
+#      python migrar_dados.py --para 3 --executar         -> transfere os órfãos para o usuário 3
+#      python migrar_dados.py --de 5 --para 3 --executar  -> transfere tudo do usuário 5 para o 3
+# Atenção: os órfãos das tabelas de sorteio e da biblioteca_busca SÃO o banco padrão de todos.
 
 TABELAS_PARA_VERIFICAR = [
-    "membros", 
-    "funcoes", 
-    "biblioteca_busca", 
-    "agitadas1", 
-    "agitadas2", 
-    "lentas1", 
-    "lentas2", 
-    "ceia", 
+    "membros",
+    "funcoes",
+    "biblioteca_busca",
+    "agitadas1",
+    "agitadas2",
+    "lentas1",
+    "lentas2",
+    "ceia",
     "infantis",
-    "categorias_repertorio"
+    "categorias_repertorio",
+    "cifras",
 ]
 
-async def main():
-    client = libsql_client.create_client(url=TURSO_URL, auth_token=TURSO_TOKEN)
-    
+def id_ou_nulo(valor):
+    return None if valor.lower() in ("null", "orfaos", "órfãos") else int(valor)
+
+def descrever(dono):
+    return "órfãos (usuario_id IS NULL)" if dono is None else f"usuário {dono}"
+
+async def gerar_relatorio(client, tabelas, origem):
+    """Quantidade e faixa de rowid de cada tabela, tudo numa consulta só."""
+    existentes = await client.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    nomes = {row[0] for row in existentes.rows}
+    for tabela in tabelas:
+        if tabela not in nomes: print(f"⚠️ Aviso: Tabela {tabela} não existe no banco e será ignorada.")
+    tabelas = [t for t in tabelas if t in nomes]
+    if not tabelas: return {}
+    consulta = " UNION ALL ".join(
+        f"SELECT '{t}', COUNT(*), MIN(rowid), MAX(rowid) FROM {t} WHERE usuario_id IS ?" for t in tabelas)
+    res = await client.execute(consulta, [origem] * len(tabelas))
+    return {row[0]: (row[1], row[2], row[3]) for row in res.rows}
+
+async def transferir_tabela(client, tabela, origem, destino, menor, maior, lote):
+    atualizadas = 0
+    inicio = time.perf_counter()
+    total_pedacos = (maior - menor) // lote + 1
+    passo = max(1, total_pedacos // 10)
+    for i, comeco in enumerate(range(menor, maior + 1, lote), start=1):
+        # Um UPDATE por pedaço: é atômico sozinho e segura o lock de escrita só pelo tempo do pedaço
+        res = await client.execute(
+            f"UPDATE {tabela} SET usuario_id = ? WHERE usuario_id IS ? AND rowid >= ? AND rowid < ?",
+            [destino, origem, comeco, comeco + lote])
+        atualizadas += res.rows_affected
+        if i % passo == 0 and i < total_pedacos:
+            print(f"   '{tabela}': {i}/{total_pedacos} pedaços, {atualizadas} registros")
+    duracao = max(time.perf_counter() - inicio, 1e-6)
+    return atualizadas, duracao
+
+async def main(args):
+    client = get_db_client()
     try:
-        # 1. Verifica se o utilizador existe
-        user_res = await client.execute("SELECT email FROM usuarios WHERE id = ?", [TARGET_USER_ID])
-        if not user_res.rows:
-            print(f"❌ ERRO: Utilizador com ID {TARGET_USER_ID} não encontrado no banco de dados!")
-            return
-        
-        email_alvo = user_res.rows[0][0]
-        print(f"👤 Utilizador Alvo Encontrado: {email_alvo} (ID: {TARGET_USER_ID})\n")
-        print("🔍 A ANALISAR O BANCO DE DADOS (Procurando dados órfãos globais)...")
-        
+        # 1. Verifica se os utilizadores existem
+        for dono in {args.de, args.para} - {None}:
+            user_res = await client.execute("SELECT email FROM usuarios WHERE id = ?", [dono])
+            if not user_res.rows:
+                print(f"❌ ERRO: Utilizador com ID {dono} não encontrado no banco de dados!")
+                return 1
+        print(f"👤 Origem: {descrever(args.de)} -> Destino: {descrever(args.para)}\n")
+
         # 2. Gera o Relatório (Dry-Run)
-        relatorio = {}
-        total_orfao = 0
-        
-        for tabela in TABELAS_PARA_VERIFICAR:
-            try:
-                res = await client.execute(f"SELECT COUNT(*) FROM {tabela} WHERE usuario_id IS NULL")
-                qtd = res.rows[0][0]
-                relatorio[tabela] = qtd
-                total_orfao += qtd
-            except Exception as e:
-                print(f"⚠️ Aviso: Tabela {tabela} ignorada (Erro: {e})")
-        
-        # Exibe o Relatório
-        print("\n📊 --- RELATÓRIO DE DADOS SEM DONO ---")
-        for tab, qtd in relatorio.items():
-            print(f"  Tabela '{tab}': {qtd} registros a transferir")
+        relatorio = await gerar_relatorio(client, args.tabelas, args.de)
+        total = sum(qtd for qtd, _, _ in relatorio.values())
+        print("📊 --- RELATÓRIO DE DADOS A TRANSFERIR ---")
+        for tabela, (qtd, _, _) in relatorio.items():
+            print(f"  Tabela '{tabela}': {qtd} registros a transferir")
         print("---------------------------------------")
-        print(f"Total de registros a serem adotados: {total_orfao}\n")
-        
-        if total_orfao == 0:
-            print("✅ Não há dados globais/órfãos para transferir. Está tudo limpo!")
-            return
-            
-        # 3. Interrompe e pede confirmação para o utilizador
-        print("⚠️ PAUSA DE SEGURANÇA ⚠️")
-        print("Copie o relatório acima e envie para a análise antes de prosseguir, se desejar.")
-        resposta = input(f"Deseja atribuir todos estes {total_orfao} registros à conta '{email_alvo}' AGORA? (s/n): ")
-        
-        # 4. Executa a Migração
-        if resposta.strip().lower() == 's':
-            print("\n🚀 Iniciando transferência de propriedade...")
-            for tab, qtd in relatorio.items():
-                if qtd > 0:
-                    await client.execute(f"UPDATE {tab} SET usuario_id = ? WHERE usuario_id IS NULL", [TARGET_USER_ID])
-                    print(f"   ✅ {qtd} registros atualizados com sucesso em '{tab}'")
-            print("\n🎉 MIGRAÇÃO CONCLUÍDA COM SUCESSO! O Multiverso agora é seu.")
-        else:
-            print("\n🛑 Operação cancelada pelo utilizador. Nenhuma alteração foi feita no banco.")
+        print(f"Total de registros: {total}\n")
+
+        if total == 0:
+            print("✅ Não há dados para transferir. Está tudo limpo!")
+            return 0
+        if not args.executar:
+            print("ℹ️  Dry-run: nada foi alterado. Rode de novo com --executar para transferir.")
+            return 0
+
+        # 3. Executa a transferência, tabela por tabela, em pedaços
+        print("🚀 Iniciando transferência de propriedade...")
+        inicio = time.perf_counter()
+        total_atualizado = 0
+        for tabela, (qtd, menor, maior) in relatorio.items():
+            if qtd == 0: continue
+            atualizadas, duracao = await transferir_tabela(client, tabela, args.de, args.para, menor, maior, args.lote)
+            total_atualizado += atualizadas
+            print(f"   ✅ {atualizadas} registros atualizados em '{tabela}' ({atualizadas / duracao:.0f} registros/s)")
 
+        duracao = max(time.perf_counter() - inicio, 1e-6)
+        print(f"\n🎉 TRANSFERÊNCIA CONCLUÍDA! {total_atualizado} registros em {duracao:.1f}s "
+              f"({total_atualizado / duracao:.0f} registros/s).")
+        if args.de is None:
+            print("   Se a API está no ar, chame POST /repertorio-padrao/recarregar (o banco padrão mudou).")
+        return 0
+    except Exception as e:
+        print(f"❌ Erro durante a transferência (os pedaços já gravados ficam; rode de novo para continuar): {e}")
+        return 1
     finally:
         await client.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Transfere dados de um tenant (ou órfãos) para um usuário.")
+    parser.add_argument("--para", type=int, required=True, help="id do usuário que vai receber os dados")
+    parser.add_argument("--de", type=id_ou_nulo, default=None, help="id do dono atual ou 'null' para órfãos (padrão)")
+    parser.add_argument("--tabelas", nargs="+", default=TABELAS_PARA_VERIFICAR)
+    parser.add_argument("--lote", type=int, default=1000, help="faixa de rowid atualizada por transação")
+    parser.add_argument("--executar", action="store_true", help="sem isso, só mostra o relatório")
+    args = parser.parse_args()
+    if args.de == args.para:
+        parser.error("--de e --para são o mesmo usuário")
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,191 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import time
+
+import libsql_client
+
+from api import get_db_client, aplicar_migracoes, CATEGORIAS_PADRAO
+
+# Copia o repertório padrão (usuario_id IS NULL) de um SQLite local para o banco configurado no .env.
+# Substitui o migrar_db.py e o migrar_sorteio.py:
+#   - lê a origem em lotes por faixa de rowid e grava cada lote com um único INSERT de várias linhas;
+#   - cada lote entra numa tabela de staging junto com o registro "lote concluído" (mesma transação),
+#     então rodar de novo depois de uma falha continua de onde parou;
+#   - só quando todos os lotes de uma tabela chegaram, um batch troca as linhas padrão de uma vez
+#     (quem continua é atualizado no lugar e mantém o id, ver comandos_troca). Músicas dos usuários nunca são tocadas.
+# Uso: python migrar_repertorio.py [--origem musicas.db] [--tabelas biblioteca_busca ceia ...]
+#                                  [--lote 500] [--paralelo 4] [--reiniciar]
+
+TABELAS = {
+    "biblioteca_busca": ["nome_musica", "tags", "link", "categoria"],
+    **{t: ["conteudo", "link"] for t in CATEGORIAS_PADRAO},
+}
+
+def staging(tabela):
+    return f"{tabela}__migracao"
+
+def assinatura_origem(conn, caminho, tabela):
+    """Se a origem mudou entre uma execução e outra, o progresso salvo não vale mais."""
+    total, maior = conn.execute(f"SELECT COUNT(*), MAX(rowid) FROM {tabela}").fetchone()
+    info = os.stat(caminho)
+    return f"{total}:{maior}:{info.st_size}:{int(info.st_mtime)}"
+
+async def preparar_destino(client):
+    await aplicar_migracoes(client)
+    await client.batch([
+        "CREATE TABLE IF NOT EXISTS migracao_progresso (tabela TEXT PRIMARY KEY, assinatura TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS migracao_lotes (tabela TEXT NOT NULL, lote INTEGER NOT NULL, linhas INTEGER NOT NULL, PRIMARY KEY (tabela, lote))",
+    ])
+
+async def reiniciar_tabela(client, tabela, colunas, assinatura):
+    definicao = ", ".join(f"{c} TEXT" for c in colunas)
+    await client.batch([
+        f"DROP TABLE IF EXISTS {staging(tabela)}",
+        f"CREATE TABLE {staging(tabela)} (origem_rowid INTEGER PRIMARY KEY, {definicao})",
+        libsql_client.Statement("DELETE FROM migracao_lotes WHERE tabela = ?", [tabela]),
+        libsql_client.Statement("INSERT OR REPLACE INTO migracao_progresso (tabela, assinatura) VALUES (?, ?)", [tabela, assinatura]),
+    ])
+
+async def lotes_concluidos(client, tabela):
+    result = await client.execute("SELECT lote, linhas FROM migracao_lotes WHERE tabela = ?", [tabela])
+    return {row[0]: row[1] for row in result.rows}
+
+def comandos_troca(tabela, colunas):
+    """Troca atômica das linhas padrão pelo staging, sem mudar o id de quem continua.
+
+    As cifras dos usuários apontam para músicas do banco padrão (cifras.musica_id), então
+    apagar tudo e inserir de novo quebraria os vínculos. Cada linha padrão atual é pareada
+    com uma do staging pela primeira coluna (nome da música / conteúdo; repetidos pareiam
+    na ordem): as pareadas são atualizadas no lugar, as que sobraram no banco saem (e as
+    cifras ligadas a elas ficam sem música) e as que sobraram no staging entram.
+    """
+    chave, pares, origem = colunas[0], f"{tabela}__pares", staging(tabela)
+    atribuicoes = ", ".join(f"{c} = s.{c}" for c in colunas)
+    lista = ", ".join(colunas)
+    comandos = [
+        f"DROP TABLE IF EXISTS {pares}",
+        f"""CREATE TABLE {pares} AS
+            SELECT d.id AS destino, s.origem_rowid AS origem FROM
+                (SELECT id, {chave}, ROW_NUMBER() OVER (PARTITION BY {chave} ORDER BY id) AS n FROM {tabela} WHERE usuario_id IS NULL) d
+            JOIN (SELECT origem_rowid, {chave}, ROW_NUMBER() OVER (PARTITION BY {chave} ORDER BY origem_rowid) AS n FROM {origem}) s
+                ON s.{chave} = d.{chave} AND s.n = d.n""",
+        f"UPDATE {tabela} SET {atribuicoes} FROM {pares} p JOIN {origem} s ON s.origem_rowid = p.origem WHERE {tabela}.id = p.destino",
+    ]
+    if tabela == "biblioteca_busca":
+        comandos.append(f"""UPDATE cifras SET musica_id = NULL WHERE musica_id IN (
+            SELECT id FROM biblioteca_busca WHERE usuario_id IS NULL AND id NOT IN (SELECT destino FROM {pares}))""")
+    return comandos + [
+        f"DELETE FROM {tabela} WHERE usuario_id IS NULL AND id NOT IN (SELECT destino FROM {pares})",
+        f"INSERT INTO {tabela} ({lista}, usuario_id) SELECT {lista}, NULL FROM {origem} WHERE origem_rowid NOT IN (SELECT origem FROM {pares}) ORDER BY origem_rowid",
+        f"DROP TABLE {pares}",
+        f"DROP TABLE {origem}",
+    ]
+
+async def concluir_todas(aguardaveis):
+    """Resultados na ordem em que terminam; se uma falha, as outras são canceladas antes do erro subir."""
+    tarefas = [asyncio.ensure_future(a) for a in aguardaveis]
+    try:
+        for tarefa in asyncio.as_completed(tarefas):
+            yield await tarefa
+    finally:
+        for tarefa in tarefas: tarefa.cancel()
+        await asyncio.gather(*tarefas, return_exceptions=True)
+
+class Migracao:
+    def __init__(self, client, conn, lote, paralelo):
+        self.client = client
+        self.conn = conn
+        self.lote = lote
+        self.semaforo = asyncio.Semaphore(paralelo)
+        self.linhas_copiadas = 0
+
+    def ler_lote(self, tabela, colunas_origem, numero, inicio):
+        selecao = ", ".join(colunas_origem)
+        return self.conn.execute(
+            f"SELECT rowid, {selecao} FROM {tabela} WHERE rowid >= ? AND rowid < ? ORDER BY rowid",
+            [inicio + numero * self.lote, inicio + (numero + 1) * self.lote]).fetchall()
+
+    async def copiar_lote(self, tabela, colunas, colunas_origem, numero, inicio):
+        async with self.semaforo:
+            linhas = self.ler_lote(tabela, colunas_origem, numero, inicio)
+            # Colunas que a origem não tem (ex.: link num musicas.db antigo) vão vazias
+            faltando = len(colunas) - len(colunas_origem)
+            valores = [("" if valor is None else valor) for linha in linhas for valor in (*linha, *([""] * faltando))]
+            statements = []
+            if linhas:
+                marcadores = ", ".join(["(" + ", ".join("?" * (len(colunas) + 1)) + ")"] * len(linhas))
+                statements.append(libsql_client.Statement(
+                    f"INSERT OR REPLACE INTO {staging(tabela)} (origem_rowid, {', '.join(colunas)}) VALUES {marcadores}", valores))
+            statements.append(libsql_client.Statement(
+                "INSERT INTO migracao_lotes (tabela, lote, linhas) VALUES (?, ?, ?)", [tabela, numero, len(linhas)]))
+            await self.client.batch(statements)
+            self.linhas_copiadas += len(linhas)
+            return len(linhas)
+
+    async def migrar_tabela(self, tabela, caminho_origem, reiniciar):
+        colunas = TABELAS[tabela]
+        existentes = {row[1] for row in self.conn.execute(f"PRAGMA table_info({tabela})")}
+        if colunas[0] not in existentes:
+            print(f"⚠️  '{tabela}' não existe na origem (ou não tem '{colunas[0]}'). Pulando.")
+            return
+        colunas_origem = [c for c in colunas if c in existentes]
+        colunas = colunas_origem + [c for c in colunas if c not in existentes]
+
+        assinatura = assinatura_origem(self.conn, caminho_origem, tabela)
+        salvo = await self.client.execute("SELECT assinatura FROM migracao_progresso WHERE tabela = ?", [tabela])
+        if reiniciar or not salvo.rows or salvo.rows[0][0] != assinatura:
+            await reiniciar_tabela(self.client, tabela, colunas, assinatura)
+
+        menor, maior = self.conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {tabela}").fetchone()
+        total_lotes = 0 if menor is None else (maior - menor) // self.lote + 1
+        feitos = await lotes_concluidos(self.client, tabela)
+        pendentes = [n for n in range(total_lotes) if n not in feitos]
+        if feitos:
+            print(f"↩️  '{tabela}': retomando ({len(feitos)}/{total_lotes} lotes já copiados).")
+
+        copiadas, concluidos = sum(feitos.values()), len(feitos)
+        passo = max(1, total_lotes // 10)
+        async for linhas in concluir_todas(self.copiar_lote(tabela, colunas, colunas_origem, n, menor) for n in pendentes):
+            copiadas += linhas
+            concluidos += 1
+            if concluidos % passo == 0 and concluidos < total_lotes:
+                print(f"   '{tabela}': {concluidos}/{total_lotes} lotes, {copiadas} linhas")
+
+        await self.client.batch(comandos_troca(tabela, colunas) + [
+            libsql_client.Statement("DELETE FROM migracao_lotes WHERE tabela = ?", [tabela]),
+            libsql_client.Statement("DELETE FROM migracao_progresso WHERE tabela = ?", [tabela]),
+        ])
+        print(f"✅ Tabela '{tabela}' migrada: {copiadas} músicas.")
+
+async def migrar(args):
+    if not os.path.exists(args.origem):
+        print(f"❌ Banco de origem '{args.origem}' não encontrado.")
+        return
+    conn = sqlite3.connect(args.origem)
+    client = get_db_client()
+    inicio = time.perf_counter()
+    try:
+        await preparar_destino(client)
+        migracao = Migracao(client, conn, args.lote, args.paralelo)
+        # As tabelas também andam em paralelo; o semáforo limita os lotes em voo no total
+        async for _ in concluir_todas(migracao.migrar_tabela(t, args.origem, args.reiniciar) for t in args.tabelas): pass
+        duracao = time.perf_counter() - inicio
+        print(f"🚀 SUCESSO! {migracao.linhas_copiadas} linhas copiadas nesta execução em {duracao:.1f}s "
+              f"({migracao.linhas_copiadas / duracao:.0f} linhas/s).")
+        print("   Se a API está no ar, chame POST /repertorio-padrao/recarregar para o sorteio ver o novo repertório.")
+    except Exception as e:
+        print(f"❌ Erro durante a migração (rode de novo para continuar de onde parou): {e}")
+    finally:
+        await client.close()
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migra o repertório padrão de um SQLite local para o banco da API.")
+    parser.add_argument("--origem", default="musicas.db")
+    parser.add_argument("--tabelas", nargs="+", default=list(TABELAS), choices=list(TABELAS))
+    parser.add_argument("--lote", type=int, default=500, help="linhas por lote (um INSERT de várias linhas)")
+    parser.add_argument("--paralelo", type=int, default=4, help="lotes gravados ao mesmo tempo")
+    parser.add_argument("--reiniciar", action="store_true", help="ignora o progresso salvo e copia tudo de novo")
+    asyncio.run(migrar(parser.parse_args()))
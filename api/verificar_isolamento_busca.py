@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import libsql_client
+
+from api import aplicar_migracoes, buscar_musicas_fts, GerenciadorIndices
+
+# Confere que a busca de um tenant nunca devolve, como closest_word, uma palavra que só existe no
+# repertório de outro tenant (nem no modo fts, cujo vocabulário de correção é do índice inteiro,
+# nem no modo memória). Monta um banco local com três donos (banco padrão e dois usuários), cada um
+# com tags "privadas", e busca em nome de cada um as palavras dos outros com erro de digitação.
+# Falha (exit 1) se alguma sugestão vazar.
+# Uso: python verificar_isolamento_busca.py [-v]
+
+REPERTORIOS = {
+    None: [("Noite Feliz", "natal,ceia,tradicional"), ("Grandioso És Tu", "adoracao,hino")],
+    1: [("Canção do Leão", "zebraconfidencial,savana"), ("Marcha Secreta", "quartzoprivado,desfile")],
+    2: [("Louvor da Manhã", "alvoradaintima,louvor"), ("Hino Reservado", "cordilheiraoculta,hino")],
+}
+
+def erros_de_digitacao(palavra):
+    """Uma letra a menos no meio e uma letra trocada no fim: a correção ortográfica deve pegar as duas."""
+    meio = len(palavra) // 2
+    return [palavra[:meio] + palavra[meio + 1:], palavra[:-1] + ("x" if palavra[-1] != "x" else "y")]
+
+def vocabulario(tenant):
+    palavras = set()
+    for nome, tags in REPERTORIOS[tenant]:
+        palavras.update(nome.lower().split())
+        palavras.update(t.strip() for t in tags.split(","))
+    return palavras
+
+async def preparar(client):
+    await aplicar_migracoes(client, fts=True)
+    await client.batch([
+        libsql_client.Statement(
+            "INSERT INTO biblioteca_busca (nome_musica, tags, usuario_id, link, categoria) VALUES (?, ?, ?, '', 'teste')",
+            [nome, tags, tenant])
+        for tenant, musicas in REPERTORIOS.items() for nome, tags in musicas
+    ])
+
+async def verificar(client, verbose):
+    indices = GerenciadorIndices(ttl=3600, max_tenants=10)
+    falhas = 0
+    for tenant in REPERTORIOS:
+        proprias = vocabulario(tenant)
+        alheias = set().union(*(vocabulario(t) for t in REPERTORIOS if t != tenant)) - proprias
+        indice = await indices.obter(client, tenant)
+        for palavra in sorted(alheias):
+            for q in erros_de_digitacao(palavra):
+                closest_fts, _ = await buscar_musicas_fts(client, tenant, q)
+                closest_memoria = indice.palavra_mais_proxima(q)
+                for modo, closest in (("fts", closest_fts), ("memória", closest_memoria)):
+                    if closest in alheias:
+                        falhas += 1
+                        print(f"❌ [{modo}] tenant {tenant} buscou {q!r} e recebeu {closest!r}, que é de outro tenant")
+                    elif verbose:
+                        print(f"✅ [{modo}] tenant {tenant}: {q!r} -> {closest!r}")
+        # Controle: a correção continua funcionando para as palavras do próprio tenant
+        for palavra in sorted(p for p in proprias if len(p) > 6):
+            q = erros_de_digitacao(palavra)[0]
+            closest_fts, _ = await buscar_musicas_fts(client, tenant, q)
+            if closest_fts != palavra:
+                falhas += 1
+                print(f"❌ [fts] tenant {tenant} buscou {q!r} e não recebeu a própria palavra {palavra!r} ({closest_fts!r})")
+    return falhas
+
+async def main(verbose=False):
+    caminho = os.path.join(tempfile.mkdtemp(), "isolamento.db")
+    client = libsql_client.create_client(f"file://{caminho}")
+    try:
+        await preparar(client)
+        falhas = await verificar(client, verbose)
+    finally:
+        await client.close()
+    print(f"\n{falhas} sugestões de outro tenant ou correções perdidas." if falhas else
+          "\n✅ Nenhuma sugestão da busca saiu do repertório de outro tenant.")
+    return falhas
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.run(main(verbose="-v" in sys.argv)) else 0)
@@ -0,0 +1,116 @@
+import ast
+import asyncio
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+import libsql_client
+
+from api import aplicar_migracoes, CATEGORIAS_PADRAO
+
+# Roda EXPLAIN QUERY PLAN em todo SQL do api.py contra um banco local com o esquema das migrações
+# e falha (exit 1) se alguma consulta varrer uma tabela inteira em vez de usar um índice.
+# Uso: python verificar_planos.py [-v]
+
+ARQUIVO_API = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api.py")
+COMANDOS_SQL = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# Valores para os trechos dinâmicos das f-strings (nome de tabela, lista de "?" etc.)
+SUBSTITUICOES = {
+    "tabela": CATEGORIAS_PADRAO,
+    "t": CATEGORIAS_PADRAO,
+    "marcadores": ["?, ?"],
+    "membro_id_sql": ["?", "(SELECT MAX(id) FROM membros WHERE usuario_id = ?)"],
+}
+
+# Varreduras que são o próprio objetivo da consulta (com o motivo)
+PERMITIDAS = {
+    # Recria o índice FTS a partir da tabela inteira (só na primeira subida em modo fts)
+    "INSERT INTO biblioteca_busca_fts(biblioteca_busca_fts) VALUES ('rebuild')": "reconstrução do FTS",
+    # Lê as versões aplicadas (uma linha por migração) na subida
+    "SELECT versao FROM schema_migracoes": "versões aplicadas",
+}
+
+def extrair_sql(caminho):
+    """Todo literal (str ou f-string) do arquivo que começa com um comando SQL, com a linha."""
+    arvore = ast.parse(open(caminho, encoding="utf-8").read())
+    dentro_de_fstring = {id(v) for n in ast.walk(arvore) if isinstance(n, ast.JoinedStr) for v in n.values}
+    docstrings = {id(n.value) for n in ast.walk(arvore) if isinstance(n, ast.Expr)}
+    encontrados = []
+    for no in ast.walk(arvore):
+        if isinstance(no, ast.Constant) and isinstance(no.value, str) and id(no) not in dentro_de_fstring | docstrings:
+            variantes = [no.value]
+        elif isinstance(no, ast.JoinedStr) and eh_sql(no.values[0]):
+            variantes = expandir_fstring(no)
+        else:
+            continue
+        for sql in variantes:
+            if eh_sql(ast.Constant(sql)):
+                encontrados.append((no.lineno, " ".join(sql.split())))
+    return sorted(set(encontrados))
+
+def eh_sql(parte):
+    return isinstance(parte, ast.Constant) and parte.value.strip().upper().startswith(COMANDOS_SQL)
+
+def expandir_fstring(no):
+    variantes = [""]
+    for parte in no.values:
+        if isinstance(parte, ast.Constant):
+            variantes = [v + parte.value for v in variantes]
+            continue
+        nome = ast.unparse(parte.value)
+        if nome not in SUBSTITUICOES:
+            raise SystemExit(f"❌ Linha {no.lineno}: trecho dinâmico desconhecido {{{nome}}}; cadastre em SUBSTITUICOES.")
+        variantes = [v + valor for v in variantes for valor in SUBSTITUICOES[nome]]
+    return variantes
+
+def montar_banco(caminho):
+    async def preparar():
+        client = libsql_client.create_client(f"file://{caminho}")
+        try:
+            await aplicar_migracoes(client, fts=True)
+        finally:
+            await client.close()
+    asyncio.run(preparar())
+    conn = sqlite3.connect(caminho)
+    tabelas = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")}
+    return conn, tabelas
+
+def varreduras_completas(plano, tabelas):
+    """Linhas "SCAN <tabela>" sem índice (ignora subconsultas, CTEs e tabelas virtuais)."""
+    problemas = []
+    for detalhe in plano:
+        m = re.match(r"SCAN (?:TABLE )?(\w+)(?: AS (\w+))?(.*)", detalhe)
+        if not m: continue
+        tabela, resto = m.group(1), m.group(3)
+        if tabela in tabelas and "USING" not in resto and "VIRTUAL TABLE" not in resto:
+            problemas.append(detalhe)
+    return problemas
+
+def main(verbose=False):
+    pasta = tempfile.mkdtemp()
+    conn, tabelas = montar_banco(os.path.join(pasta, "planos.db"))
+    falhas = 0
+    consultas = extrair_sql(ARQUIVO_API)
+    for linha, sql in consultas:
+        try:
+            parametros = [None] * sql.count("?")
+            plano = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parametros)]
+        except sqlite3.Error as e:
+            falhas += 1
+            print(f"❌ api.py:{linha} não compilou ({e}):\n   {sql}")
+            continue
+        problemas = [] if sql in PERMITIDAS else varreduras_completas(plano, tabelas)
+        if problemas:
+            falhas += 1
+            print(f"❌ api.py:{linha} varre a tabela inteira ({'; '.join(problemas)}):\n   {sql}")
+        elif verbose:
+            print(f"✅ api.py:{linha} {' | '.join(plano)}\n   {sql}")
+    conn.close()
+    print(f"\n{len(consultas)} consultas verificadas, {falhas} com problema.")
+    return falhas
+
+if __name__ == "__main__":
+    sys.exit(1 if main(verbose="-v" in sys.argv) else 0)